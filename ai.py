@@ -1,18 +1,33 @@
 """This module handles AI chat requests"""
 
-import json
+import asyncio
+import functools
 import logging
-import os
 import time
 import uuid
 from typing import AsyncGenerator
 
-import langid
 from fastapi import HTTPException
 
-from chat import chat_storage_manager
+from chat import chat_storage_manager, run_db, submit_db
+from config import server_timing, tts_min_segment_chars, tts_mode
+from context import estimate_tokens
+from logs import log_payload, preview, sample_payload
+from metrics import StageTimer
 from ollama import ask_ollama_stream
-from speech import process_audio_file_common, save_speak_file
+from speech import (
+    IncrementalSpeech,
+    audio_url_for,
+    process_audio_file_common,
+    save_speak_file,
+)
+from summary import channel_summarizer
+
+# Seconds between checks whether the client of a chat stream is still there.
+DISCONNECT_POLL_INTERVAL = 0.5
+# Seconds the stream of a new channel's first answer stays open after "done"
+# for its title; a later title still reaches the client through /api/data.
+TITLE_WAIT = 5
 
 
 def process_audio_file(file):
@@ -48,86 +63,317 @@ def detect_language(text: str) -> str:
     Detect the language of the given text using langid.
     Returns the language code (e.g., 'en', 'fr', etc.).
     """
+    import langid
+
     return langid.classify(text)[0]
 
 
+def _log_request(channel_id, model, user_input, chat_history, with_payload=False):
+    logging.info(
+        "Sending %d messages of channel %s to %s, input: %s",
+        len(chat_history),
+        channel_id,
+        model,
+        preview(user_input),
+    )
+    if with_payload:
+        log_payload(f"LLM request of channel {channel_id}", chat_history)
+
+
+def _log_response(channel_id, response, with_payload=False):
+    logging.info(
+        "Response from LLM for channel %s, %d characters: %s",
+        channel_id,
+        len(response),
+        preview(response),
+    )
+    if with_payload:
+        log_payload(f"LLM response of channel {channel_id}", response)
+
+
+def _timed_detect_language(timer: StageTimer, text: str) -> str:
+    with timer.stage("language_detection"):
+        return detect_language(text)
+
+
+async def _watch_disconnect(request, disconnected: asyncio.Event):
+    """Set `disconnected` as soon as the HTTP client goes away."""
+    while not disconnected.is_set():
+        if await request.is_disconnected():
+            disconnected.set()
+            return
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+
+async def _unless_disconnected(awaitable, disconnected: asyncio.Event):
+    """Await `awaitable`, giving up early if the client disconnects."""
+    task = asyncio.ensure_future(awaitable)
+    disconnect_wait = asyncio.ensure_future(disconnected.wait())
+    try:
+        await asyncio.wait({task, disconnect_wait}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect_wait.cancel()
+        if not task.done():
+            task.cancel()
+
+
+def _channel_name_event(channel_id: str, channel_name: str) -> dict:
+    """Tells the client the generated name of a new channel."""
+    return {"type": "meta", "channel_id": channel_id, "channel_name": channel_name}
+
+
+def _turn_messages(
+    user_input, response, model, audio_url="", truncated=False, response_tokens=None
+):
+    """
+    The history rows stored for one finished or abandoned turn: the question
+    and the answer, or only the question when the client left before any of
+    the answer arrived. Token counts are estimated unless Ollama reported the
+    real one.
+    """
+    response = response.strip()
+    ai_message = {
+        "role": "ai",
+        "content": response,
+        "audio_url": audio_url,
+        "token_count": response_tokens or estimate_tokens(response, model),
+    }
+    if truncated:
+        ai_message["truncated"] = True
+    user_message = {
+        "role": "user",
+        "content": user_input,
+        "token_count": estimate_tokens(user_input, model),
+    }
+    if truncated and not response:
+        return [user_message]
+    return [user_message, ai_message]
+
+
 async def response_stream_generator(
-    channel_id, session_id, user_input, is_file_uploaded, chat_history, model
-) -> AsyncGenerator[str, None]:
+    channel_id,
+    session_id,
+    user_input,
+    is_file_uploaded,
+    chat_history,
+    model,
+    ticket=None,
+    request=None,
+    new_channel=None,
+    timer=None,
+) -> AsyncGenerator[dict, None]:
+    """
+    Stream the answer to `user_input` as events (see events.py) and save the
+    turn once it is complete. The stages are timed by `timer`.
+    """
     audio_request_id = str(uuid.uuid4())
-    start_json = "$[[START_JSON]]"
-    end_json = "$[[END_JSON]]"
+    if timer is None:
+        timer = StageTimer(model)
+    detect = functools.partial(_timed_detect_language, timer)
 
-    audio_file_path = os.path.join("static", "audio", f"audio-{audio_request_id}.mp3")
-    _start_json = {}
+    start_event = {"type": "meta"}
     if is_file_uploaded:
-        _start_json["resolved_text"] = user_input
-
-    early_chunk = f"{start_json}{json.dumps(_start_json)}{end_json}\n"
-
-    yield early_chunk
+        start_event["resolved_text"] = user_input
+    if ticket is not None and ticket.position:
+        start_event["queue_position"] = ticket.position
+    title_task = None
+    if new_channel is not None:
+        start_event["channel_id"] = channel_id
+        start_event["channel_name"] = new_channel["name"]
+        title_task = new_channel["title"]
 
-    yield "\n"
+    yield start_event
 
     step_start_time = time.time()
     accumulated_response = ""
-    logging.info(
-        "Sending request to LLM with input: %s history: %s", user_input, chat_history
-    )
+    response_tokens = None
+    with_payload = sample_payload()
+    _log_request(channel_id, model, user_input, chat_history, with_payload)
+
+    speech = None
+    segments_sent = 0
+    if tts_mode == "incremental":
+        speech = IncrementalSpeech(
+            audio_request_id,
+            detect,
+            tts_min_segment_chars,
+            functools.partial(timer.record, "tts"),
+        )
+
+    disconnected = asyncio.Event()
+    watcher = None
+    if request is not None:
+        watcher = asyncio.create_task(_watch_disconnect(request, disconnected))
 
     try:
-        async for chunk in ask_ollama_stream(model, chat_history):
-            if isinstance(chunk, dict):
-                content_chunk = chunk.get("message", {}).get("content", "")
-                if content_chunk:
-                    accumulated_response += content_chunk
-                    logging.debug("Yielding dict chunk: %s", content_chunk)
-                    yield content_chunk
-            elif isinstance(chunk, str) and chunk != "":
-                accumulated_response += chunk
-                logging.debug("Yielding string chunk: %s", chunk)
-                yield chunk
-    except Exception as e:
-        logging.error("Error during response streaming: %s", e)
-        yield str(e)
+        try:
+            if ticket is not None:
+                with timer.stage("queue"):
+                    await _unless_disconnected(ticket.wait(), disconnected)
+            requested_at = time.perf_counter()
+            first_token_at = None
+            eval_duration = None
+            async for chunk in ask_ollama_stream(model, chat_history, disconnected):
+                if isinstance(chunk, dict):
+                    if chunk.get("done"):
+                        response_tokens = chunk.get("eval_count")
+                        eval_duration = chunk.get("eval_duration")
+                    content_chunk = chunk.get("message", {}).get("content", "")
+                elif isinstance(chunk, str):
+                    content_chunk = chunk
+                else:
+                    continue
+                if not content_chunk:
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    timer.record("ttft", first_token_at - requested_at)
+                accumulated_response += content_chunk
+                logging.debug("Yielding chunk: %s", content_chunk)
+                yield {"type": "token", "text": content_chunk}
+                if title_task is not None and title_task.done():
+                    title = title_task.result()
+                    # The client already shows the provisional name.
+                    if title and title != new_channel["name"]:
+                        yield _channel_name_event(channel_id, title)
+                    title_task = None
+                if speech is not None:
+                    speech.feed(content_chunk)
+                    for audio_url in speech.pop_ready():
+                        yield {
+                            "type": "audio",
+                            "audio_url": audio_url,
+                            "index": segments_sent,
+                        }
+                        segments_sent += 1
+            if first_token_at is not None:
+                generation_time = time.perf_counter() - first_token_at
+                timer.record("generation", generation_time)
+                if eval_duration:
+                    # Ollama's own measurement, in nanoseconds.
+                    timer.record_rate(response_tokens, eval_duration / 1e9)
+                else:
+                    timer.record_rate(
+                        estimate_tokens(accumulated_response, model), generation_time
+                    )
+        except Exception as e:
+            logging.error("Error during response streaming: %s", e)
+            yield {"type": "error", "detail": str(e)}
+        finally:
+            if ticket is not None:
+                ticket.release()
+    except (asyncio.CancelledError, GeneratorExit):
+        # The server tore the response down; nothing can be awaited any more.
+        disconnected.set()
+        if speech is not None:
+            speech.cancel()
+        submit_db(
+            chat_storage_manager.append_chat_messages,
+            session_id,
+            channel_id,
+            _turn_messages(user_input, accumulated_response, model, truncated=True),
+        )
+        raise
+    finally:
+        if watcher is not None:
+            watcher.cancel()
 
-    logging.info("Response from LLM: %s", accumulated_response)
+    if disconnected.is_set():
+        if speech is not None:
+            speech.cancel()
+        logging.info(
+            "Client left channel %s mid-answer, saving %d characters without audio",
+            channel_id,
+            len(accumulated_response),
+        )
+        await run_db(
+            chat_storage_manager.append_chat_messages,
+            session_id,
+            channel_id,
+            _turn_messages(user_input, accumulated_response, model, truncated=True),
+        )
+        return
+
+    _log_response(channel_id, accumulated_response, with_payload)
 
     if not accumulated_response:
         logging.error("No response received from LLM.")
+        yield {"type": "done"}
         return
 
-    lang = detect_language(accumulated_response)
-    logging.info("Detected language: %s ", lang)
     audio_url = ""
     try:
-        await save_speak_file(accumulated_response, lang, audio_request_id)
-        logging.info(
-            "Generated audio file at %s. Time taken: %.2f seconds",
-            audio_file_path,
-            time.time() - step_start_time,
-        )
-        audio_start = "$[[AUDIO_DONE]]"
-        audio_end = "$[[AUDIO_DONE]]"
-        audio_url = f"/static/audio/audio-{audio_request_id}.mp3"
-        audio_json = json.dumps(
-            {
+        if speech is not None:
+            speech.finish()
+            async for segment_url in speech.remaining():
+                yield {
+                    "type": "audio",
+                    "audio_url": segment_url,
+                    "index": segments_sent,
+                }
+                segments_sent += 1
+            audio_file_path = speech.combine()
+        else:
+            lang = detect(accumulated_response)
+            logging.info("Detected language: %s ", lang)
+            with timer.stage("tts"):
+                audio_file_path = await save_speak_file(
+                    accumulated_response, lang, audio_request_id
+                )
+        if audio_file_path:
+            logging.info(
+                "Generated audio file at %s. Time taken: %.2f seconds",
+                audio_file_path,
+                time.time() - step_start_time,
+            )
+            audio_url = audio_url_for(audio_file_path)
+            logging.debug("Yielding final audio event")
+            yield {
+                "type": "audio",
                 "audio_url": audio_url,
                 "channel_id": channel_id,
+                "final": True,
             }
+    except (asyncio.CancelledError, GeneratorExit):
+        if speech is not None:
+            speech.cancel()
+        submit_db(
+            chat_storage_manager.append_chat_messages,
+            session_id,
+            channel_id,
+            _turn_messages(user_input, accumulated_response, model),
         )
-        audio_chunk = f"\n{audio_start}{audio_json}{audio_end}"
-        logging.debug("Yielding AUDIO_DONE chunk")
-        yield audio_chunk
+        raise
     except Exception as e:
         logging.error(f"Audio generation failed: {e}")
 
-    chat_history.append(
-        {"role": "ai", "content": accumulated_response.strip(), "audio_url": audio_url}
-    )
-    chat_storage_manager.save_chat_history(session_id, channel_id, chat_history)
+    with timer.stage("history_save"):
+        await run_db(
+            chat_storage_manager.append_chat_messages,
+            session_id,
+            channel_id,
+            _turn_messages(
+                user_input,
+                accumulated_response,
+                model,
+                audio_url,
+                response_tokens=response_tokens,
+            ),
+        )
+    channel_summarizer.schedule(session_id, channel_id)
+    if server_timing:
+        yield {"type": "timing", "stages": timer.milliseconds()}
+    yield {"type": "done"}
     logging.info(
         "Saved chat history for channel %s. Time taken: %.2f seconds",
         channel_id,
         time.time() - step_start_time,
     )
+    if title_task is not None:
+        # Sent after "done" so a slow title model does not hold the answer back.
+        try:
+            title = await asyncio.wait_for(asyncio.shield(title_task), TITLE_WAIT)
+        except asyncio.TimeoutError:
+            title = None
+        if title and title != new_channel["name"]:
+            yield _channel_name_event(channel_id, title)
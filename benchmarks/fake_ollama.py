@@ -0,0 +1,168 @@
+"""
+A stand-in for one or more Ollama servers, for load tests and for trying out
+multi-host routing without GPUs.
+
+Each server answers /api/tags with its own model list and streams /api/chat
+responses at a configurable time-to-first-token and tokens per second.
+GET /_fake/stats reports how many requests a server received and how many
+streams are in flight.
+
+Usage:
+    python benchmarks/fake_ollama.py --server 11501:llama3,phi3 --server 11502:llama3
+    OLLAMA_HOST=http://127.0.0.1:11501,http://127.0.0.1:11502 make run
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from aiohttp import web
+
+DEFAULT_TEXT = (
+    "Sure. Here is a short answer to your question. "
+    "It is generated by a fake Ollama server, so it does not mean much. "
+    "Each word arrives as its own token, just like a real model would send it. "
+    "Is there anything else I can help you with?"
+)
+
+
+class FakeOllama:
+    """The state and handlers of one fake Ollama server."""
+
+    def __init__(self, models, ttft, tokens_per_second, text, fail=False):
+        self.models = models
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.tokens = [word + " " for word in text.split()]
+        self.fail = fail
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def tags(self, _request):
+        return web.json_response(
+            {"models": [{"name": name, "model": name} for name in self.models]}
+        )
+
+    async def stats(self, _request):
+        return web.json_response(
+            {
+                "requests": self.requests,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+            }
+        )
+
+    async def chat(self, request):
+        self.requests += 1
+        if self.fail:
+            return web.json_response({"error": "fake failure"}, status=500)
+
+        body = await request.json()
+        model = body.get("model")
+        if model not in self.models:
+            return web.json_response(
+                {"error": f"model '{model}' not found"}, status=404
+            )
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.ttft)
+            if not body.get("stream", True):
+                await asyncio.sleep(len(self.tokens) / self.tokens_per_second)
+                return web.json_response(self._frame(model, "".join(self.tokens), True))
+
+            response = web.StreamResponse(
+                headers={"Content-Type": "application/x-ndjson"}
+            )
+            await response.prepare(request)
+            delay = 1 / self.tokens_per_second
+            for token in self.tokens:
+                await response.write(
+                    (json.dumps(self._frame(model, token, False)) + "\n").encode()
+                )
+                await asyncio.sleep(delay)
+            await response.write(
+                (json.dumps(self._frame(model, "", True)) + "\n").encode()
+            )
+            await response.write_eof()
+            return response
+        finally:
+            self.in_flight -= 1
+
+    def _frame(self, model, content, done):
+        return {
+            "model": model,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "message": {"role": "assistant", "content": content},
+            "done": done,
+        }
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get("/api/tags", self.tags)
+        app.router.add_post("/api/chat", self.chat)
+        app.router.add_get("/_fake/stats", self.stats)
+        return app
+
+
+async def start_servers(specs, host="127.0.0.1", **options):
+    """
+    Start one fake server per (port, models) spec and return the runners,
+    which the caller cleans up with `await runner.cleanup()`.
+    """
+    runners = []
+    for port, models in specs:
+        runner = web.AppRunner(FakeOllama(models, **options).make_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        runners.append(runner)
+    return runners
+
+
+def parse_server(spec):
+    port, _, models = spec.partition(":")
+    return int(port), [name for name in models.split(",") if name] or ["fake"]
+
+
+async def serve(args):
+    runners = await start_servers(
+        args.server,
+        host=args.host,
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        text=args.text,
+    )
+    for port, models in args.server:
+        print(f"Fake Ollama on http://{args.host}:{port} with {', '.join(models)}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--server",
+        type=parse_server,
+        action="append",
+        help="PORT:model1,model2 (repeatable)",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--text", default=DEFAULT_TEXT)
+    args = parser.parse_args()
+    args.server = args.server or [(11434, ["fake"])]
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""
+Load test of the whole server. Starts `main:app` under uvicorn against a fake
+Ollama server, the fake TTS and STT backends and, when no ffmpeg is
+installed, an ffmpeg stand-in that passes audio through unchanged. Then N
+simulated users each run a number of turns: a text or voice message to
+/api/chat/, then /api/history/{channel_id} and /api/data.
+
+Reports throughput, time to first token and end-to-end latency percentiles
+per request type, errors by status, and the server's event loop lag from
+/metrics. The results, with the commit and settings they were measured at,
+are printed and written to --output so runs can be compared across commits.
+
+Usage:
+    python benchmarks/load_test.py --users 20 --turns 5 --output load.json
+    python benchmarks/load_test.py --users 50 --voice-ratio 0.5 --tokens-per-second 30
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import shutil
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_ollama import DEFAULT_TEXT, start_servers  # noqa: E402
+from metrics import percentile  # noqa: E402
+
+MODEL = "fake"
+LAG_METRIC = "promptlama_event_loop_lag_seconds"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 1),
+        "p95_ms": round(percentile(samples, 95) * 1000, 1),
+        "p99_ms": round(percentile(samples, 99) * 1000, 1),
+        "max_ms": round(max(samples) * 1000, 1),
+    }
+
+
+def utterance(seconds=1.0, rate=16000):
+    """Raw 16 kHz PCM, which the ffmpeg stand-in passes through."""
+    return b"".join(
+        struct.pack("<h", int(8000 * math.sin(2 * math.pi * 220 * i / rate)))
+        for i in range(int(seconds * rate))
+    )
+
+
+def fake_ffmpeg(bin_dir):
+    path = os.path.join(bin_dir, "ffmpeg")
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\nexec cat\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def lag_buckets(metrics_text):
+    """Cumulative bucket counts of the event loop lag histogram."""
+    pattern = re.compile(rf'^{LAG_METRIC}_bucket{{le="([^"]+)"}} (\d+)$', re.M)
+    return [(float(le), int(count)) for le, count in pattern.findall(metrics_text)]
+
+
+def bucket_quantile(buckets, q):
+    """Estimate a quantile from cumulative buckets, like histogram_quantile."""
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    rank = q * total
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if math.isinf(bound):
+                return lower_bound
+            share = (rank - lower_count) / max(count - lower_count, 1)
+            return lower_bound + (bound - lower_bound) * share
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+
+    def record(self, name, seconds):
+        self.latencies[name].append(seconds)
+
+    def error(self, name, status):
+        self.errors[f"{name}:{status}"] += 1
+
+
+async def chat_turn(session, base_url, stats, channel_id, voice):
+    form = aiohttp.FormData()
+    form.add_field("model", MODEL)
+    form.add_field("stream_format", "ndjson")
+    if channel_id:
+        form.add_field("channel_id", channel_id)
+    if voice:
+        form.add_field("file", utterance(), filename="audio.wav")
+    else:
+        form.add_field("text", "Tell me something about load testing.")
+    kind = "voice" if voice else "text"
+
+    started = time.perf_counter()
+    async with session.post(f"{base_url}/api/chat/", data=form) as response:
+        if response.status != 200:
+            await response.read()
+            stats.error(f"chat_{kind}", response.status)
+            return channel_id
+        first_token = None
+        async for line in response.content:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event["type"] == "meta" and event.get("channel_id"):
+                channel_id = event["channel_id"]
+            elif event["type"] == "token" and first_token is None:
+                first_token = time.perf_counter() - started
+                stats.record(f"chat_{kind}_ttft", first_token)
+            elif event["type"] == "error":
+                stats.error(f"chat_{kind}", "stream")
+            elif event["type"] == "done":
+                stats.record(f"chat_{kind}", time.perf_counter() - started)
+    return channel_id
+
+
+async def timed_get(session, url, stats, name):
+    started = time.perf_counter()
+    async with session.get(url) as response:
+        await response.read()
+        if response.status != 200:
+            stats.error(name, response.status)
+            return
+    stats.record(name, time.perf_counter() - started)
+
+
+async def user(base_url, stats, turns, voice_ratio, rng):
+    async with aiohttp.ClientSession(
+        cookie_jar=aiohttp.CookieJar(unsafe=True),
+        timeout=aiohttp.ClientTimeout(total=300),
+    ) as session:
+        await timed_get(session, f"{base_url}/api/data", stats, "data")
+        channel_id = None
+        for _ in range(turns):
+            voice = rng.random() < voice_ratio
+            try:
+                channel_id = await chat_turn(
+                    session, base_url, stats, channel_id, voice
+                )
+            except aiohttp.ClientError as e:
+                stats.error("chat", type(e).__name__)
+            if channel_id:
+                await timed_get(
+                    session, f"{base_url}/api/history/{channel_id}", stats, "history"
+                )
+            await timed_get(session, f"{base_url}/api/data", stats, "data")
+
+
+async def wait_until_ready(base_url, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                sys.exit(f"Server exited with code {server.returncode}")
+            try:
+                async with session.get(f"{base_url}/api/data") as response:
+                    data = await response.json()
+                    if response.status == 200 and data.get("models"):
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    sys.exit("Server did not become ready")
+
+
+async def fetch_metrics(base_url):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{base_url}/metrics") as response:
+            return await response.text()
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="promptlama-load-")
+    os.makedirs(os.path.join(workdir, "static", "audio"))
+    ollama_port = free_port()
+    port = free_port()
+    env = dict(
+        os.environ,
+        PYTHONPATH=ROOT,
+        OLLAMA_HOST=f"http://127.0.0.1:{ollama_port}",
+        DATABASE_URL=f"sqlite:///{workdir}/chat.db",
+        TTS_BACKEND="fake",
+        STT_BACKEND="fake",
+        LOG_FILE=os.path.join(workdir, "server.log"),
+    )
+    env.setdefault("STARTUP_WARMUP", "eager")
+    if args.fake_ffmpeg or shutil.which("ffmpeg") is None:
+        bin_dir = os.path.join(workdir, "bin")
+        os.makedirs(bin_dir)
+        fake_ffmpeg(bin_dir)
+        env["PATH"] = bin_dir + os.pathsep + env.get("PATH", "")
+
+    runners = await start_servers(
+        [(ollama_port, [MODEL])],
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        text=DEFAULT_TEXT,
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        await wait_until_ready(base_url, server)
+        lag_before = lag_buckets(await fetch_metrics(base_url))
+
+        stats = Stats()
+        rng = random.Random(args.seed)
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(
+                user(base_url, stats, args.turns, args.voice_ratio, rng)
+                for _ in range(args.users)
+            )
+        )
+        elapsed = time.perf_counter() - started
+
+        lag_after = lag_buckets(await fetch_metrics(base_url))
+    finally:
+        server.terminate()
+        server.wait()
+        for runner in runners:
+            await runner.cleanup()
+
+    before = dict(lag_before)
+    lag = [(bound, count - before.get(bound, 0)) for bound, count in lag_after]
+    turns = sum(len(stats.latencies[k]) for k in ("chat_text", "chat_voice"))
+    requests = sum(len(samples) for samples in stats.latencies.values()) - sum(
+        len(stats.latencies[k]) for k in ("chat_text_ttft", "chat_voice_ttft")
+    )
+    return {
+        "commit": commit(),
+        "settings": vars(args),
+        "elapsed_s": round(elapsed, 2),
+        "throughput": {
+            "turns_per_s": round(turns / elapsed, 2),
+            "requests_per_s": round(requests / elapsed, 2),
+        },
+        "latency": {
+            name: percentiles(samples)
+            for name, samples in sorted(stats.latencies.items())
+        },
+        "errors": dict(stats.errors),
+        "event_loop_lag_ms": {
+            f"p{int(q * 100)}": (
+                None
+                if bucket_quantile(lag, q) is None
+                else round(bucket_quantile(lag, q) * 1000, 2)
+            )
+            for q in (0.5, 0.95, 0.99)
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=5, help="chat turns per user")
+    parser.add_argument(
+        "--voice-ratio", type=float, default=0.2, help="share of voice turns"
+    )
+    parser.add_argument("--ttft", type=float, default=0.2, help="fake Ollama, s")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--fake-ffmpeg",
+        action="store_true",
+        help="use the ffmpeg stand-in even when ffmpeg is installed",
+    )
+    parser.add_argument("--output", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Measures the time a chat turn spends in logging calls on the event loop, for
+a long channel.
+
+`before` logs the full history and answer synchronously to a file, as the
+server used to. `after` logs through the queue handler with previews, and
+`after_sampled` also logs the full payloads, as a sampled turn does; they are
+serialized on a separate thread, so only contention with it shows up here. Stdout goes to /dev/null in all cases.
+
+Usage:
+    python benchmarks/logging_overhead.py --messages 500 --message-chars 400
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORKDIR = tempfile.mkdtemp(prefix="promptlama-logging-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{WORKDIR}/chat.db")
+os.environ["LOG_FILE"] = os.path.join(WORKDIR, "server.log")
+os.chdir(WORKDIR)
+
+import ai  # noqa: E402
+import logs  # noqa: E402
+from metrics import percentile  # noqa: E402
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+def make_turn(messages, message_chars):
+    text = ("The quick brown fox jumps over the lazy dog. " * 20)[:message_chars]
+    history = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": text}
+        for i in range(messages)
+    ]
+    history.append({"role": "user", "content": text})
+    return text, history, text * 10
+
+
+def log_before(user_input, history, response):
+    logging.info(
+        "Sending request to LLM with input: %s history: %s", user_input, history
+    )
+    logging.info("Response from LLM: %s", response)
+
+
+def log_after(user_input, history, response, log_payload=False):
+    ai._log_request("channel", "model", user_input, history, log_payload)
+    ai._log_response("channel", response, log_payload)
+
+
+def timed(turns, log_turn, *args):
+    samples = []
+    for _ in range(turns):
+        started = time.perf_counter()
+        log_turn(*args)
+        samples.append(time.perf_counter() - started)
+    return {
+        "mean_ms": round(statistics.mean(samples) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--message-chars", type=int, default=400)
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+
+    user_input, history, response = make_turn(args.messages, args.message_chars)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    root = logging.getLogger()
+    results = {}
+
+    file_handler = logging.FileHandler(os.path.join(WORKDIR, "before.log"))
+    stream_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root.handlers = [file_handler, stream_handler]
+    root.setLevel(logging.INFO)
+    results["before"] = timed(args.turns, log_before, user_input, history, response)
+    file_handler.close()
+
+    logs.setup_logging()
+    results["after"] = timed(args.turns, log_after, user_input, history, response)
+    results["after_sampled"] = timed(
+        args.turns, log_after, user_input, history, response, True
+    )
+
+    sys.stdout = stdout
+    results["history_chars"] = len(json.dumps(history))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
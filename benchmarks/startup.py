@@ -0,0 +1,88 @@
+"""
+Measures how long the server takes to start: importing `main` and running
+the FastAPI lifespan until it is ready to serve, for each STARTUP_WARMUP mode.
+
+Every run is a fresh interpreter in an empty working directory with an empty
+database and an unreachable Ollama host, like a new autoscaled instance. The
+`process_s` column includes the interpreter start itself and, in background
+mode, waiting for the warm-up to finish before the interpreter exits.
+
+Usage:
+    python benchmarks/startup.py --modes lazy,background,eager --runs 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child():
+    os.chdir(os.environ["STARTUP_BENCH_WORKDIR"])
+    sys.path.insert(0, ROOT)
+    started = time.perf_counter()
+    import main
+
+    imported = time.perf_counter()
+
+    async def start():
+        async with main.lifespan(main.app):
+            return time.perf_counter()
+
+    ready = asyncio.run(start())
+    print(json.dumps({"import_s": imported - started, "lifespan_s": ready - imported}))
+
+
+def run_once(mode):
+    workdir = tempfile.mkdtemp(prefix="promptlama-startup-")
+    os.makedirs(os.path.join(workdir, "static", "audio"))
+    env = dict(
+        os.environ,
+        STARTUP_BENCH_WORKDIR=workdir,
+        STARTUP_WARMUP=mode,
+        DATABASE_URL=f"sqlite:///{workdir}/chat.db",
+        OLLAMA_HOST="http://127.0.0.1:9",
+        OLLAMA_CONNECT_TIMEOUT="1",
+    )
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_s"] = time.perf_counter() - started
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", default="lazy,background,eager")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    results = {}
+    for mode in args.modes.split(","):
+        runs = [run_once(mode) for _ in range(args.runs)]
+        results[mode] = {
+            key: round(statistics.median(run[key] for run in runs), 3)
+            for key in ("import_s", "lifespan_s", "process_s")
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Compares the default SQLite setup against the "production" storage profile.
+
+Two databases are seeded with the same users, channels and messages. The
+"before" database uses the default profile without the composite channel
+index, the "after" database uses the production profile with it. Reader
+threads then replay the /api/data and /api/history lookups while writer
+threads keep appending turns, like finishing streams do.
+
+Usage:
+    python benchmarks/storage_profile.py --users 2000 --channels 20 --duration 10
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORKDIR = tempfile.mkdtemp(prefix="promptlama-bench-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{WORKDIR}/import.db")
+
+from sqlalchemy import insert, text  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+import chat  # noqa: E402
+from metrics import percentile  # noqa: E402
+
+
+def seed(engine, users, channels_per_user, messages_per_channel):
+    chat.init_schema(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            insert(chat.User),
+            [{"id": i, "user_id": f"user-{i}"} for i in range(1, users + 1)],
+        )
+        channel_rows = []
+        message_rows = []
+        channel_pk = 0
+        for user_pk in range(1, users + 1):
+            for _ in range(channels_per_user):
+                channel_pk += 1
+                channel_rows.append(
+                    {
+                        "id": channel_pk,
+                        "channel_id": f"channel-{channel_pk}",
+                        "channel_name": f"Channel {channel_pk}",
+                        "user_id": user_pk,
+                    }
+                )
+                message_rows.extend(
+                    {
+                        "channel_id": channel_pk,
+                        "sequence": sequence,
+                        "role": "user" if sequence % 2 else "ai",
+                        "content": "lorem ipsum dolor sit amet " * 8,
+                    }
+                    for sequence in range(1, messages_per_channel + 1)
+                )
+        conn.execute(insert(chat.Channel), channel_rows)
+        conn.execute(insert(chat.Message), message_rows)
+
+
+def run_workload(manager, users, channels_per_user, readers, writers, duration):
+    stop = threading.Event()
+    read_latencies = []
+    write_latencies = []
+    lock = threading.Lock()
+
+    def reader():
+        rng = random.Random()
+        local = []
+        while not stop.is_set():
+            user_pk = rng.randint(1, users)
+            channel_pk = (user_pk - 1) * channels_per_user + rng.randint(
+                1, channels_per_user
+            )
+            start = time.perf_counter()
+            manager.get_channels(f"user-{user_pk}")
+            manager.load_chat_history(f"user-{user_pk}", f"channel-{channel_pk}")
+            local.append(time.perf_counter() - start)
+        with lock:
+            read_latencies.extend(local)
+
+    def writer():
+        rng = random.Random()
+        local = []
+        while not stop.is_set():
+            user_pk = rng.randint(1, users)
+            channel_pk = (user_pk - 1) * channels_per_user + rng.randint(
+                1, channels_per_user
+            )
+            start = time.perf_counter()
+            manager.append_chat_messages(
+                f"user-{user_pk}",
+                f"channel-{channel_pk}",
+                [
+                    {"role": "user", "content": "question"},
+                    {"role": "ai", "content": "answer " * 50, "audio_url": ""},
+                ],
+            )
+            local.append(time.perf_counter() - start)
+        with lock:
+            write_latencies.extend(local)
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    def summary(samples):
+        return {
+            "count": len(samples),
+            "per_second": round(len(samples) / duration, 1),
+            "p50_ms": round(statistics.median(samples) * 1000, 2) if samples else 0,
+            "p95_ms": round(percentile(samples, 95) * 1000, 2),
+            "p99_ms": round(percentile(samples, 99) * 1000, 2),
+        }
+
+    return {"reads": summary(read_latencies), "writes": summary(write_latencies)}
+
+
+def bench(label, profile, with_index, args):
+    url = f"sqlite:///{WORKDIR}/{label}.db"
+    engine = chat.create_storage_engine(url, profile)
+    seed(engine, args.users, args.channels, args.messages)
+    if not with_index:
+        with engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_channels_user_id_created_at"))
+    manager = chat.ChatStorageManager(sessionmaker(bind=engine, expire_on_commit=False))
+    result = run_workload(
+        manager, args.users, args.channels, args.readers, args.writers, args.duration
+    )
+    engine.dispose()
+    return {"profile": profile, "composite_index": with_index, **result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--channels", type=int, default=20, help="per user")
+    parser.add_argument("--messages", type=int, default=6, help="per channel")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    args = parser.parse_args()
+
+    results = {
+        "before": bench("before", "default", False, args),
+        "after": bench("after", "production", True, args),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Compares per-utterance latency of the speech recognition backends.
+
+Each backend is loaded once, then transcribes the same utterance several
+times, like the STT pool does across requests. The utterance is a 16 kHz mono
+WAV file given with --wav, or a few seconds of generated tone otherwise.
+Backends that cannot be loaded (missing package or model, no network) are
+reported with the error instead of timings.
+
+Usage:
+    python benchmarks/stt_backends.py --backends fake,vosk --wav hello.wav --runs 10
+    STT_VOSK_MODEL=models/vosk-model-small-tr-0.3 python benchmarks/stt_backends.py
+"""
+
+import argparse
+import json
+import math
+import os
+import statistics
+import struct
+import sys
+import time
+import wave
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import stt  # noqa: E402
+from metrics import percentile  # noqa: E402
+
+
+def generated_utterance(seconds):
+    samples = (
+        int(8000 * math.sin(2 * math.pi * 220 * i / stt.PCM_SAMPLE_RATE))
+        for i in range(int(seconds * stt.PCM_SAMPLE_RATE))
+    )
+    return b"".join(struct.pack("<h", sample) for sample in samples)
+
+
+def read_utterance(path):
+    with wave.open(path, "rb") as wav:
+        if (
+            wav.getframerate() != stt.PCM_SAMPLE_RATE
+            or wav.getnchannels() != 1
+            or wav.getsampwidth() != stt.PCM_SAMPLE_WIDTH
+        ):
+            sys.exit(f"{path} must be 16 kHz mono 16 bit PCM")
+        return wav.readframes(wav.getnframes())
+
+
+def bench(name, pcm, language, runs):
+    started = time.perf_counter()
+    try:
+        backend = stt.get_stt_backend(name)
+    except Exception as e:
+        return {"error": str(e)}
+    load_time = time.perf_counter() - started
+
+    latencies = []
+    transcript = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        try:
+            transcript = backend.recognize(pcm, language)
+        except Exception as e:
+            return {"load_s": round(load_time, 3), "error": repr(e)}
+        latencies.append(time.perf_counter() - started)
+
+    return {
+        "load_s": round(load_time, 3),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "transcript": transcript,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--backends", default="fake,vosk,google")
+    parser.add_argument("--wav", help="16 kHz mono WAV file")
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--language", default="tr")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    pcm = read_utterance(args.wav) if args.wav else generated_utterance(args.seconds)
+    results = {
+        "utterance_s": round(len(pcm) / stt.PCM_SAMPLE_WIDTH / stt.PCM_SAMPLE_RATE, 2)
+    }
+    for name in args.backends.split(","):
+        results[name] = bench(name, pcm, args.language, args.runs)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
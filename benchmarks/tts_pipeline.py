@@ -0,0 +1,127 @@
+"""
+Measures time-to-first-audio of the "full" and "incremental" TTS modes.
+
+A fake Ollama server streams an answer and the fake TTS backend stands in for
+edge_tts, taking FAKE_TTS_LATENCY seconds plus FAKE_TTS_SECONDS_PER_CHAR per
+character. Each mode runs the real chat stream generator and records when the
+first text, the first playable audio and the end of the stream arrive.
+
+Usage:
+    python benchmarks/tts_pipeline.py --runs 5 --tokens-per-second 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PORT = 11599
+WORKDIR = tempfile.mkdtemp(prefix="promptlama-tts-")
+os.makedirs(os.path.join(WORKDIR, "static", "audio"))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{WORKDIR}/chat.db")
+os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{PORT}"
+os.environ["TTS_BACKEND"] = "fake"
+# Every run synthesizes the same answer, so the audio cache would hide the TTS.
+os.environ["TTS_CACHE_MAX_MB"] = "0"
+os.chdir(WORKDIR)
+
+from sqlalchemy import insert  # noqa: E402
+
+import ai  # noqa: E402
+import chat  # noqa: E402
+from benchmarks.fake_ollama import DEFAULT_TEXT, start_servers  # noqa: E402
+from ollama import close_http_session, model_registry  # noqa: E402
+
+USER_ID = "bench-user"
+CHANNEL_ID = "bench-channel"
+
+
+def seed():
+    chat.init_schema(chat.engine)
+    with chat.engine.begin() as conn:
+        conn.execute(insert(chat.User), [{"id": 1, "user_id": USER_ID}])
+        conn.execute(
+            insert(chat.Channel),
+            [
+                {
+                    "id": 1,
+                    "channel_id": CHANNEL_ID,
+                    "channel_name": "bench",
+                    "user_id": 1,
+                }
+            ],
+        )
+
+
+async def run_once(mode):
+    ai.tts_mode = mode
+    start = time.perf_counter()
+    first_text = first_audio = None
+    async for event in ai.response_stream_generator(
+        CHANNEL_ID,
+        USER_ID,
+        "question",
+        False,
+        [{"role": "user", "content": "question"}],
+        "fake",
+    ):
+        now = time.perf_counter() - start
+        if event["type"] == "audio":
+            first_audio = first_audio or now
+        elif event["type"] == "token" and event["text"].strip():
+            first_text = first_text or now
+    return {
+        "first_text": first_text,
+        "first_audio": first_audio,
+        "done": time.perf_counter() - start,
+    }
+
+
+def summary(samples):
+    return {
+        key: round(statistics.median(sample[key] for sample in samples), 3)
+        for key in ("first_text", "first_audio", "done")
+    }
+
+
+async def bench(args):
+    runners = await start_servers(
+        [(PORT, ["fake"])],
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        text=args.text,
+    )
+    try:
+        await model_registry.refresh()
+        results = {}
+        for mode in ("full", "incremental"):
+            samples = [await run_once(mode) for _ in range(args.runs)]
+            results[mode] = summary(samples)
+        return results
+    finally:
+        await close_http_session()
+        for runner in runners:
+            await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=20.0)
+    parser.add_argument("--text", default=DEFAULT_TEXT)
+    args = parser.parse_args()
+
+    seed()
+    print(json.dumps(asyncio.run(bench(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
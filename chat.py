@@ -1,37 +1,142 @@
+import asyncio
+import functools
+import itertools
 import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-import nltk
 from fastapi import HTTPException
 from sqlalchemy import (
+    Boolean,
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
+    UniqueConstraint,
     create_engine,
+    delete,
+    event,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
+    update,
 )
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
-from sqlalchemy.sql import func
-
-nltk.download("punkt_tab")
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, declarative_base, relationship, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from cache import LRUCache
+from config import (
+    channel_cache_size,
+    database_url,
+    db_max_overflow,
+    db_pool_size,
+    db_workers,
+    sqlite_cache_size_kb,
+    sqlite_mmap_size,
+    storage_profile,
+    user_cache_size,
+)
+from context import build_context_window, estimate_tokens
 
 MAX_HISTORY_LENGTH = 10000
-MAX_CONTEXT_LENGTH = 3000
+# Sentence tokenizer data the title summarizer needs; it is never downloaded
+# at runtime, install it with `python -m nltk.downloader punkt_tab`.
+NLTK_PUNKT = "tokenizers/punkt_tab"
+# Upper bound of rows read for an LLM call, whatever the token budget.
+MAX_CONTEXT_MESSAGES = 1000
+APPEND_RETRIES = 3
+# Channel changes remembered per cached channel list for delta responses.
+MAX_CHANNEL_CHANGES = 1000
 
 Base = declarative_base()
 
 DATABASE_FOLDER = "databases"
-DATABASE_FILE = "chat_storage.db"
-DATABASE_URL = f"sqlite:///{DATABASE_FOLDER}/{DATABASE_FILE}"
+DATABASE_URL = database_url
 
 os.makedirs(DATABASE_FOLDER, exist_ok=True)
 
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+STORAGE_PROFILES = ("default", "production")
+
+
+def _apply_sqlite_production_pragmas(dbapi_connection, _connection_record):
+    """
+    Tunes every new SQLite connection for concurrent readers and writers:
+    WAL lets readers proceed while a stream is committing its history.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={sqlite_mmap_size}")
+        cursor.execute(f"PRAGMA cache_size=-{sqlite_cache_size_kb}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA busy_timeout=5000")
+    finally:
+        cursor.close()
+
+
+def create_storage_engine(url: str = DATABASE_URL, profile: str = storage_profile):
+    """Create the database engine for the given storage profile."""
+    if profile not in STORAGE_PROFILES:
+        raise ValueError(
+            f"Unknown storage profile {profile!r}, expected one of {STORAGE_PROFILES}"
+        )
+
+    is_sqlite = url.startswith("sqlite")
+    storage_engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False} if is_sqlite else {},
+        poolclass=QueuePool,
+        pool_size=db_pool_size,
+        max_overflow=db_max_overflow,
+        pool_pre_ping=True,
+    )
+    if profile == "production" and is_sqlite:
+        event.listen(storage_engine, "connect", _apply_sqlite_production_pragmas)
+    return storage_engine
+
+
+engine = create_storage_engine()
+SessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+)
+
+# Blocking database work is run here so it never stalls the event loop.
+_db_executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="db")
+
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking storage call on the database thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _db_executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+def submit_db(func, *args, **kwargs):
+    """
+    Schedule a storage call on the database thread pool without waiting for
+    it, for cleanup code that can no longer await.
+    """
+    future = _db_executor.submit(func, *args, **kwargs)
+    future.add_done_callback(_log_db_error)
+    return future
+
+
+def _log_db_error(future):
+    if future.exception() is not None:
+        logging.error("Background storage call failed: %s", future.exception())
 
 
 class User(Base):
@@ -43,191 +148,723 @@ class User(Base):
 
 class Channel(Base):
     __tablename__ = "channels"
+    __table_args__ = (Index("ix_channels_user_id_created_at", "user_id", "created_at"),)
     id = Column(Integer, primary_key=True, index=True)
     channel_id = Column(String, unique=True, index=True)
     channel_name = Column(String)
     user_id = Column(Integer, ForeignKey("users.id"))
-    history = Column(Text)
+    # Legacy JSON blob, only read by _migrate_history_blobs.
+    history = Column(Text, nullable=True)
     user = relationship("User", back_populates="channels")
+    messages = relationship("Message", back_populates="channel")
+    created_at = Column(DateTime, default=func.now())
+
+
+class Message(Base):
+    __tablename__ = "messages"
+    __table_args__ = (
+        UniqueConstraint("channel_id", "sequence", name="uq_messages_channel_sequence"),
+    )
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(Integer, ForeignKey("channels.id"), nullable=False)
+    sequence = Column(Integer, nullable=False)
+    role = Column(String, nullable=False)
+    content = Column(Text, nullable=False, default="")
+    audio_url = Column(String, nullable=True, index=True)
+    # Set when the client went away before the answer was complete.
+    truncated = Column(Boolean, nullable=False, default=False, server_default="0")
+    # Tokens of `content`, as reported by Ollama or estimated when stored.
+    token_count = Column(Integer, nullable=True)
+    channel = relationship("Channel", back_populates="messages")
     created_at = Column(DateTime, default=func.now())
 
+    def to_dict(self, for_llm: bool = False):
+        message = {"role": self.role, "content": self.content}
+        if for_llm:
+            return message
+        message["sequence"] = self.sequence
+        if self.audio_url is not None:
+            message["audio_url"] = self.audio_url
+        if self.truncated:
+            message["truncated"] = True
+        return message
+
+
+class ChannelSummary(Base):
+    """A rolling summary of the messages of a channel up to a sequence number."""
 
-Base.metadata.create_all(bind=engine)
+    __tablename__ = "channel_summaries"
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(Integer, ForeignKey("channels.id"), nullable=False, unique=True)
+    content = Column(Text, nullable=False)
+    covered_until_sequence = Column(Integer, nullable=False)
+    token_count = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+def _add_missing_columns(bind):
+    """
+    create_all never alters existing tables, so columns added to a model after
+    its table was created are added here. Such columns must be nullable or
+    have a server default.
+    """
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=bind.dialect)
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+                conn.execute(text(ddl))
+                logging.info("Added column %s.%s", table.name, column.name)
+
+
+def _ensure_indexes(bind):
+    """
+    create_all only adds indexes together with a new table, so indexes added
+    to existing tables are created here.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+
+def _migrate_history_blobs(bind):
+    """
+    Moves conversations stored in the legacy `channels.history` JSON column
+    into the `messages` table, one row per message.
+    """
+    db = Session(bind=bind)
+    try:
+        channels = db.query(Channel).filter(Channel.history.isnot(None)).all()
+        for channel in channels:
+            try:
+                history = json.loads(channel.history or "[]")
+            except json.JSONDecodeError:
+                logging.error("Skipping unreadable history of channel %s", channel.id)
+                history = []
+            history = history[-MAX_HISTORY_LENGTH:]
+            db.add_all(
+                Message(
+                    channel_id=channel.id,
+                    sequence=sequence,
+                    role=message.get("role", ""),
+                    content=message.get("content", ""),
+                    audio_url=message.get("audio_url"),
+                )
+                for sequence, message in enumerate(history, start=1)
+            )
+            channel.history = None
+            if history:
+                logging.info(
+                    "Migrated %d messages of channel %s", len(history), channel.id
+                )
+        db.commit()
+    finally:
+        db.close()
+
+
+def init_schema(bind):
+    """Create missing tables and indexes and migrate legacy data."""
+    Base.metadata.create_all(bind=bind)
+    _add_missing_columns(bind)
+    _ensure_indexes(bind)
+    _migrate_history_blobs(bind)
+
+
+class ChannelList:
+    """
+    A user's channels, newest first, as of `version`, and which of them were
+    changed or deleted at which version since the list was read from the
+    database at version `loaded_at`. `channels` is None while it is read.
+    """
+
+    def __init__(self, version: int):
+        self.version = version
+        self.loaded_at = version
+        self.channels = None
+        self.changed = {}
+        self.deleted = {}
+
+    def set_channel(self, version: int, channel_id: str, channel_name: str):
+        """Add a new channel at the top of the list or rename one."""
+        channel = {"id": channel_id, "name": channel_name}
+        for index, existing in enumerate(self.channels):
+            if existing["id"] == channel_id:
+                self.channels[index] = channel
+                break
+        else:
+            self.channels.insert(0, channel)
+        self._record(version, self.changed, channel_id)
+
+    def remove_channels(self, version: int, channel_ids):
+        channel_ids = set(channel_ids)
+        self.channels = [c for c in self.channels if c["id"] not in channel_ids]
+        for channel_id in channel_ids:
+            self.changed.pop(channel_id, None)
+            self._record(version, self.deleted, channel_id)
+
+    def _record(self, version, changes, channel_id):
+        self.version = version
+        changes[channel_id] = version
+        if len(self.changed) + len(self.deleted) > MAX_CHANNEL_CHANGES:
+            # Clients further behind than this get the whole list.
+            self.changed.clear()
+            self.deleted.clear()
+            self.loaded_at = version
+
+    def snapshot(self, since_version: int | None = None) -> dict:
+        """
+        The whole list, or only the changes after `since_version` when the
+        changes since then are known.
+        """
+        if since_version is None or not (
+            self.loaded_at <= since_version <= self.version
+        ):
+            return {"version": self.version, "channels": list(self.channels)}
+        return {
+            "version": self.version,
+            "changed": [
+                channel
+                for channel in self.channels
+                if self.changed.get(channel["id"], 0) > since_version
+            ],
+            "deleted": [
+                channel_id
+                for channel_id, version in self.deleted.items()
+                if version > since_version
+            ],
+        }
 
 
 class ChatStorageManager:
     """
     A class to manage chat storage, including creating users and channels,
     saving and loading chat history, and deleting channels.
+
+    Every public method runs as its own unit of work on a fresh session taken
+    from the engine's connection pool, so the manager can be shared between
+    threads and concurrent requests.
     """
 
-    def __init__(self):
-        self.db = SessionLocal()
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        user_cache_size=user_cache_size,
+        channel_cache_size=channel_cache_size,
+    ):
+        self._session_factory = session_factory
+        # session id -> users.id, so most lookups skip the users table.
+        self._user_ids = LRUCache(user_cache_size)
+        # session id -> ChannelList, kept up to date by the methods changing
+        # channels. Versions start at the current time in milliseconds so
+        # ones handed out before a restart are not mistaken for current ones.
+        self._channel_lists = LRUCache(channel_cache_size)
+        self._channel_versions = itertools.count(int(time.time() * 1000))
+        self._channel_lock = threading.Lock()
+
+    @contextmanager
+    def _session(self):
+        db = self._session_factory()
+        try:
+            yield db
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _get_user_pk(self, db, user_id: str):
+        user_pk = self._user_ids.get(user_id)
+        if user_pk is None:
+            user_pk = db.query(User.id).filter(User.user_id == user_id).scalar()
+            if user_pk is not None:
+                self._user_ids.set(user_id, user_pk)
+        return user_pk
+
+    def _get_or_create_user_pk(self, db, user_id: str):
+        user_pk = self._get_user_pk(db, user_id)
+        if user_pk is None:
+            user = User(user_id=user_id)
+            db.add(user)
+            try:
+                db.commit()
+            except IntegrityError:
+                # Another request created the same user concurrently.
+                db.rollback()
+                return self._get_user_pk(db, user_id)
+            user_pk = user.id
+            self._user_ids.set(user_id, user_pk)
+        return user_pk
+
+    def _owned_by(self, query, user_id: str):
+        """
+        Restricts a query over channels to those owned by `user_id`, joining
+        the users table only when the user's primary key is not cached.
+        """
+        user_pk = self._user_ids.get(user_id)
+        if user_pk is not None:
+            return query.filter(Channel.user_id == user_pk)
+        return query.join(User, Channel.user_id == User.id).filter(
+            User.user_id == user_id
+        )
+
+    def _get_channel_pk(self, db, user_id: str, channel_id: str):
+        query = db.query(Channel.id).filter(Channel.channel_id == channel_id)
+        return self._owned_by(query, user_id).scalar()
 
     def create_user(self, user_id: str):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            user = User(user_id=user_id)
-            self.db.add(user)
-            self.db.commit()
-            self.db.refresh(user)
-        return user
+        with self._session() as db:
+            user_pk = self._get_or_create_user_pk(db, user_id)
+            return db.get(User, user_pk)
 
     def create_channel(self, user_id: str, channel_id: str, text: str):
-        user = self.create_user(user_id)
-        channel = (
-            self.db.query(Channel).filter(Channel.channel_id == channel_id).first()
-        )
+        with self._session() as db:
+            user_pk = self._get_or_create_user_pk(db, user_id)
+            channel = (
+                db.query(Channel.id).filter(Channel.channel_id == channel_id).first()
+            )
 
-        if channel:
-            raise HTTPException(status_code=400, detail="Channel already exists")
+            if channel:
+                raise HTTPException(status_code=400, detail="Channel already exists")
 
-        channel_name = generate_summary_title(text)
-        channel = Channel(
-            channel_id=channel_id,
-            channel_name=channel_name,
-            user_id=user.id,
-            history="[]",
+            channel_name = provisional_title(text)
+            channel = Channel(
+                channel_id=channel_id,
+                channel_name=channel_name,
+                user_id=user_pk,
+            )
+            db.add(channel)
+            db.commit()
+        self._update_channel_list(
+            user_id, lambda cl, v: cl.set_channel(v, channel_id, channel_name)
         )
-        self.db.add(channel)
-        self.db.commit()
-        self.db.refresh(channel)
         return channel
 
-    def get_channels(self, user_id: str):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            return []
-
-        channels = (
-            self.db.query(Channel)
-            .filter(Channel.user_id == user.id)
-            .order_by(Channel.created_at.desc())
-            .all()
+    def rename_channel(self, user_id: str, channel_id: str, channel_name: str):
+        with self._session() as db:
+            channel_pk = self._get_channel_pk(db, user_id, channel_id)
+            if channel_pk is None:
+                raise HTTPException(status_code=404, detail="Channel not found")
+            db.execute(
+                update(Channel)
+                .where(Channel.id == channel_pk)
+                .values(channel_name=channel_name)
+            )
+            db.commit()
+        self._update_channel_list(
+            user_id, lambda cl, v: cl.set_channel(v, channel_id, channel_name)
         )
-        return [
-            {"id": channel.channel_id, "name": channel.channel_name}
-            for channel in channels
-        ]
 
-    def does_channel_exist(self, user_id: str, channel_id: str):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            return False
-
-        channel = (
-            self.db.query(Channel)
-            .filter(Channel.channel_id == channel_id, Channel.user_id == user.id)
-            .first()
-        )
-        return channel is not None
+    def get_channels(self, user_id: str):
+        return self.get_channel_list(user_id)["channels"]
 
-    def save_chat_history(self, user_id: str, channel_id: str, history):
-        logging.info(
-            f"Saving chat history for channel {channel_id}. {history} for user {user_id}"
-        )
-        if not isinstance(history, list):
-            raise HTTPException(status_code=400, detail="History must be a list")
+    def get_channel_list(self, user_id: str, since_version: int | None = None):
+        """
+        The user's channels, newest first, with the version of the list. Given
+        a `since_version` returned earlier, only the channels created or
+        renamed since then are returned as `changed` and the ids of deleted
+        ones as `deleted`, unless the changes are no longer known.
+        """
+        with self._channel_lock:
+            channel_list = self._channel_lists.get(user_id)
+            if channel_list is not None and channel_list.channels is not None:
+                return channel_list.snapshot(since_version)
+            channel_list = ChannelList(next(self._channel_versions))
+            self._channel_lists.set(user_id, channel_list)
+
+        channels = self._load_channels(user_id)
+        with self._channel_lock:
+            # Not cached when a change was made while the list was read.
+            if self._channel_lists.get(user_id) is channel_list:
+                channel_list.channels = channels
+        return {"version": channel_list.version, "channels": list(channels)}
+
+    def _load_channels(self, user_id: str):
+        with self._session() as db:
+            query = db.query(Channel.channel_id, Channel.channel_name)
+            channels = (
+                self._owned_by(query, user_id).order_by(Channel.created_at.desc()).all()
+            )
+            return [
+                {"id": channel.channel_id, "name": channel.channel_name}
+                for channel in channels
+            ]
+
+    def _update_channel_list(self, user_id: str, update):
+        """Apply `update(channel_list, version)` to the cached channels."""
+        with self._channel_lock:
+            channel_list = self._channel_lists.get(user_id)
+            if channel_list is None:
+                return
+            if channel_list.channels is None:
+                # It is being read and may miss this change, so drop it.
+                self._channel_lists.pop(user_id)
+                return
+            update(channel_list, next(self._channel_versions))
 
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+    def does_channel_exist(self, user_id: str, channel_id: str):
+        with self._session() as db:
+            return self._get_channel_pk(db, user_id, channel_id) is not None
 
-        channel = (
-            self.db.query(Channel)
-            .filter(Channel.channel_id == channel_id, Channel.user_id == user.id)
-            .first()
+    def append_chat_messages(self, user_id: str, channel_id: str, messages):
+        """
+        Appends new messages to the end of a channel's history. Only the given
+        rows are written; the existing history is never rewritten.
+        """
+        logging.info(
+            "Appending %d messages to channel %s for user %s",
+            len(messages),
+            channel_id,
+            user_id,
         )
-        if not channel:
-            raise HTTPException(status_code=404, detail="Channel not found")
-
-        if len(history) > MAX_HISTORY_LENGTH:
-            history = history[-MAX_HISTORY_LENGTH:]
-
-        channel.history = json.dumps(history)
-        self.db.commit()
-        result = self.load_chat_history(user_id, channel_id)
-        print(f"Saved chat history: {result}")
+        if not isinstance(messages, list):
+            raise HTTPException(status_code=400, detail="Messages must be a list")
+
+        for attempt in range(1, APPEND_RETRIES + 1):
+            try:
+                self._append_chat_messages_once(user_id, channel_id, messages)
+                return
+            except IntegrityError:
+                # A concurrent turn on the same channel took our sequence numbers.
+                if attempt == APPEND_RETRIES:
+                    raise
+                logging.warning(
+                    "Sequence conflict on channel %s, retrying append", channel_id
+                )
+
+    def _append_chat_messages_once(self, user_id: str, channel_id: str, messages):
+        with self._session() as db:
+            channel_pk = self._get_channel_pk(db, user_id, channel_id)
+            if channel_pk is None:
+                raise HTTPException(status_code=404, detail="Channel not found")
+
+            # The next sequence number is computed inside each INSERT so the
+            # read and the write happen under the same database write lock.
+            last_sequence = (
+                select(func.coalesce(func.max(Message.sequence), 0))
+                .where(Message.channel_id == channel_pk)
+                .scalar_subquery()
+            )
+            for message in messages:
+                db.execute(
+                    insert(Message).values(
+                        channel_id=channel_pk,
+                        sequence=last_sequence + 1,
+                        role=message["role"],
+                        content=message.get("content", ""),
+                        audio_url=message.get("audio_url"),
+                        truncated=message.get("truncated", False),
+                        token_count=message.get("token_count")
+                        or estimate_tokens(message.get("content", "")),
+                    )
+                )
+
+            db.execute(
+                delete(Message).where(
+                    Message.channel_id == channel_pk,
+                    Message.sequence <= last_sequence - MAX_HISTORY_LENGTH,
+                )
+            )
+            db.commit()
 
     def load_chat_history(
-        self, user_id: str, channel_id: str, is_llm_call: bool = False
+        self,
+        user_id: str,
+        channel_id: str,
+        is_llm_call: bool = False,
+        limit: int | None = None,
+        model: str | None = None,
     ):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            return []
-
-        channel = (
-            self.db.query(Channel)
-            .filter(Channel.channel_id == channel_id, Channel.user_id == user.id)
-            .first()
-        )
-        if not channel:
-            return []
-
-        full_history = json.loads(channel.history)
-
+        """
+        Loads the history of a channel in chronological order. When `limit` is
+        given only the most recent `limit` messages are read from the database.
+        For LLM calls the history is cut to the token budget of `model`.
+        """
         if is_llm_call:
-            filtered_history = []
-            for message in full_history:
-                filtered_message = {
-                    k: v for k, v in message.items() if k != "audio_url"
-                }
-                filtered_history.append(filtered_message)
-            truncated = self._truncate_history_by_character_length(
-                filtered_history, MAX_CONTEXT_LENGTH
-            )
-            return truncated
+            return self._load_context_window(user_id, channel_id, model)
 
-        return full_history
+        with self._session() as db:
+            query = (
+                db.query(Message)
+                .join(Channel, Message.channel_id == Channel.id)
+                .filter(Channel.channel_id == channel_id)
+            )
+            query = self._owned_by(query, user_id).order_by(Message.sequence.desc())
+            if limit is not None:
+                query = query.limit(limit)
+            rows = query.all()
+            rows.reverse()
+
+        return [row.to_dict() for row in rows]
+
+    def load_history_page(
+        self,
+        user_id: str,
+        channel_id: str,
+        limit: int,
+        before: int | None = None,
+        since: int | None = None,
+    ):
+        """
+        Loads one page of a channel's history in chronological order: the
+        latest `limit` messages, the last `limit` before sequence `before`, or
+        the first `limit` after sequence `since`. `has_more` tells whether
+        there are further messages in the direction of the page.
+        """
+        with self._session() as db:
+            query = (
+                db.query(Message)
+                .join(Channel, Message.channel_id == Channel.id)
+                .filter(Channel.channel_id == channel_id)
+            )
+            query = self._owned_by(query, user_id)
+            if since is not None:
+                query = query.filter(Message.sequence > since).order_by(
+                    Message.sequence
+                )
+            else:
+                if before is not None:
+                    query = query.filter(Message.sequence < before)
+                query = query.order_by(Message.sequence.desc())
+            rows = query.limit(limit + 1).all()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if since is None:
+            rows.reverse()
+        return {"history": [row.to_dict() for row in rows], "has_more": has_more}
+
+    def get_history_version(self, user_id: str, channel_id: str) -> str:
+        """
+        A version of a channel's history that changes whenever it does.
+        Messages are only edited to drop audio evicted from the TTS cache, and
+        old ones are only trimmed when new ones are appended, so the channel
+        and its last sequence number identify it.
+        """
+        with self._session() as db:
+            query = (
+                db.query(Channel.id, func.max(Message.sequence))
+                .outerjoin(Message, Message.channel_id == Channel.id)
+                .filter(Channel.channel_id == channel_id)
+                .group_by(Channel.id)
+            )
+            row = self._owned_by(query, user_id).first()
+        if row is None:
+            return "0.0"
+        channel_pk, last_sequence = row
+        return f"{channel_pk}.{last_sequence or 0}"
+
+    def referenced_audio_urls(self, audio_urls) -> set[str]:
+        """The ones of `audio_urls` that stored messages point to."""
+        with self._session() as db:
+            rows = (
+                db.query(Message.audio_url)
+                .filter(Message.audio_url.in_(audio_urls))
+                .distinct()
+            )
+            return {row.audio_url for row in rows}
+
+    def clear_audio_urls(self, audio_urls):
+        """Drop the audio of the messages pointing to `audio_urls`."""
+        with self._session() as db:
+            db.execute(
+                update(Message)
+                .where(Message.audio_url.in_(audio_urls))
+                .values(audio_url=None)
+            )
+            db.commit()
+
+    def _load_context_window(self, user_id: str, channel_id: str, model):
+        with self._session() as db:
+            query = (
+                db.query(
+                    Channel.id,
+                    ChannelSummary.content,
+                    ChannelSummary.covered_until_sequence,
+                    ChannelSummary.token_count,
+                )
+                .outerjoin(ChannelSummary, ChannelSummary.channel_id == Channel.id)
+                .filter(Channel.channel_id == channel_id)
+            )
+            channel = self._owned_by(query, user_id).first()
+            if channel is None:
+                return []
+            channel_pk, summary, covered_until, summary_tokens = channel
+
+            rows = (
+                db.query(Message.role, Message.content, Message.token_count)
+                .filter(
+                    Message.channel_id == channel_pk,
+                    Message.sequence > (covered_until or 0),
+                )
+                .order_by(Message.sequence.desc())
+                .limit(MAX_CONTEXT_MESSAGES)
+            )
+            summary_message = None
+            if summary:
+                summary_message = (
+                    "system",
+                    f"Summary of the earlier conversation:\n{summary}",
+                    summary_tokens,
+                )
+            return build_context_window(rows.yield_per(64), model, summary_message)
+
+    def load_unsummarized_messages(self, user_id: str, channel_id: str):
+        """
+        Returns the channel's current summary, the sequence it covers and the
+        (sequence, role, content, token_count) rows after it, oldest first.
+        """
+        with self._session() as db:
+            query = (
+                db.query(
+                    Channel.id,
+                    ChannelSummary.content,
+                    ChannelSummary.covered_until_sequence,
+                )
+                .outerjoin(ChannelSummary, ChannelSummary.channel_id == Channel.id)
+                .filter(Channel.channel_id == channel_id)
+            )
+            channel = self._owned_by(query, user_id).first()
+            if channel is None:
+                return None, 0, []
+            channel_pk, summary, covered_until = channel
+            covered_until = covered_until or 0
+
+            rows = (
+                db.query(
+                    Message.sequence, Message.role, Message.content, Message.token_count
+                )
+                .filter(
+                    Message.channel_id == channel_pk,
+                    Message.sequence > covered_until,
+                )
+                .order_by(Message.sequence)
+                .limit(MAX_CONTEXT_MESSAGES)
+                .all()
+            )
+            return summary, covered_until, [tuple(row) for row in rows]
+
+    def save_channel_summary(
+        self,
+        user_id: str,
+        channel_id: str,
+        content: str,
+        covered_until_sequence: int,
+        token_count: int,
+    ):
+        """Store a summary unless a newer one was saved in the meantime."""
+        with self._session() as db:
+            channel_pk = self._get_channel_pk(db, user_id, channel_id)
+            if channel_pk is None:
+                return
+            summary = (
+                db.query(ChannelSummary)
+                .filter(ChannelSummary.channel_id == channel_pk)
+                .first()
+            )
+            if summary is None:
+                summary = ChannelSummary(channel_id=channel_pk)
+                db.add(summary)
+            elif summary.covered_until_sequence >= covered_until_sequence:
+                return
+            summary.content = content
+            summary.covered_until_sequence = covered_until_sequence
+            summary.token_count = token_count
+            db.commit()
 
     def delete_channel(self, user_id: str, channel_id: str):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        channel = (
-            self.db.query(Channel)
-            .filter(Channel.channel_id == channel_id, Channel.user_id == user.id)
-            .first()
+        with self._session() as db:
+            user_pk = self._get_user_pk(db, user_id)
+            if user_pk is None:
+                raise HTTPException(status_code=404, detail="User not found")
+
+            channel_pk = self._get_channel_pk(db, user_id, channel_id)
+            if channel_pk is None:
+                raise HTTPException(status_code=404, detail="Channel not found")
+
+            db.execute(delete(Message).where(Message.channel_id == channel_pk))
+            db.execute(
+                delete(ChannelSummary).where(ChannelSummary.channel_id == channel_pk)
+            )
+            db.execute(delete(Channel).where(Channel.id == channel_pk))
+            db.commit()
+        self._user_ids.pop(user_id)
+        self._update_channel_list(
+            user_id, lambda cl, v: cl.remove_channels(v, [channel_id])
         )
-        if not channel:
-            raise HTTPException(status_code=404, detail="Channel not found")
-
-        self.db.delete(channel)
-        self.db.commit()
 
     def delete_all_channels(self, user_id: str):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+        with self._session() as db:
+            user_pk = self._get_user_pk(db, user_id)
+            if user_pk is None:
+                raise HTTPException(status_code=404, detail="User not found")
+
+            channel_ids = select(Channel.id).where(Channel.user_id == user_pk)
+            db.execute(delete(Message).where(Message.channel_id.in_(channel_ids)))
+            db.execute(
+                delete(ChannelSummary).where(ChannelSummary.channel_id.in_(channel_ids))
+            )
+            db.execute(delete(Channel).where(Channel.user_id == user_pk))
+            db.commit()
+        self._user_ids.pop(user_id)
+        self._update_channel_list(
+            user_id,
+            lambda cl, v: cl.remove_channels(v, [c["id"] for c in cl.channels]),
+        )
 
-        self.db.query(Channel).filter(Channel.user_id == user.id).delete()
-        self.db.commit()
 
-    def _truncate_history_by_character_length(self, history, max_characters):
-        """
-        Truncates the chat history to ensure the total character count is within the specified limit.
-        """
-        total_characters = 0
-        truncated_history = []
+# Words of the first message used as a channel name until the real title is ready.
+PROVISIONAL_TITLE_WORDS = 6
 
-        for message in reversed(history):
-            message_length = len(message)
-            if total_characters + message_length > max_characters:
-                break
-            truncated_history.insert(0, message)
-            total_characters += message_length
 
-        return truncated_history
+def provisional_title(text: str | None) -> str:
+    words = (text or "").split()
+    if not words:
+        return "New chat"
+    title = " ".join(words[:PROVISIONAL_TITLE_WORDS])
+    return title + "..." if len(words) > PROVISIONAL_TITLE_WORDS else title
 
 
-def generate_summary_title(text):
+@functools.lru_cache(maxsize=1)
+def _title_summarizer():
+    """
+    Build the sumy tokenizer and summarizer once; loading them is slow.
+    Returns None when the NLTK data is not installed.
+    """
+    import nltk
+
+    try:
+        nltk.data.find(NLTK_PUNKT)
+    except LookupError:
+        logging.warning(
+            "NLTK data %s is missing, titles use the first words of a chat. "
+            "Install it with `python -m nltk.downloader punkt_tab`.",
+            NLTK_PUNKT,
+        )
+        return None
+
     from sumy.nlp.tokenizers import Tokenizer
-    from sumy.parsers.plaintext import PlaintextParser
     from sumy.summarizers.lsa import LsaSummarizer
 
-    parser = PlaintextParser.from_string(text, Tokenizer("english"))
-    summarizer = LsaSummarizer()
+    return Tokenizer("english"), LsaSummarizer()
+
+
+def generate_summary_title(text):
+    components = _title_summarizer()
+    if components is None:
+        return provisional_title(text)
+
+    from sumy.parsers.plaintext import PlaintextParser
+
+    tokenizer, summarizer = components
+    parser = PlaintextParser.from_string(text, tokenizer)
     summary = summarizer(parser.document, 1)
     return " ".join(str(sentence) for sentence in summary)
 
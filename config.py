@@ -6,10 +6,161 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+
+def _model_overrides(name: str, cast) -> dict:
+    """Parse a "model=value,model=value" environment variable."""
+    return {
+        model.strip(): cast(value)
+        for model, _, value in (
+            item.rpartition("=")
+            for item in os.getenv(name, "").split(",")
+            if "=" in item
+        )
+    }
+
+
 host = os.getenv("HOST", "http://localhost")
 port = os.getenv("PORT", "8000")
 
-ollama_host = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+# A comma separated list of Ollama servers to balance requests across.
+ollama_hosts = [
+    ollama_host.strip().rstrip("/")
+    for ollama_host in os.getenv("OLLAMA_HOST", "http://localhost:11434").split(",")
+    if ollama_host.strip()
+]
+ollama_host = ollama_hosts[0]
+ollama_connect_timeout = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+ollama_read_timeout = float(os.getenv("OLLAMA_READ_TIMEOUT", "300"))
+ollama_pool_size = int(os.getenv("OLLAMA_POOL_SIZE", "100"))
+ollama_keepalive_timeout = float(os.getenv("OLLAMA_KEEPALIVE_TIMEOUT", "60"))
+ollama_models_refresh_interval = float(
+    os.getenv("OLLAMA_MODELS_REFRESH_INTERVAL", "60")
+)
+# Minimum seconds between refreshes triggered by requests for unknown models.
+ollama_models_miss_refresh_interval = float(
+    os.getenv("OLLAMA_MODELS_MISS_REFRESH_INTERVAL", "5")
+)
+# Consecutive failures after which a host is ejected for OLLAMA_EJECT_SECONDS.
+ollama_max_failures = int(os.getenv("OLLAMA_MAX_FAILURES", "3"))
+ollama_eject_seconds = float(os.getenv("OLLAMA_EJECT_SECONDS", "30"))
+
+# Admission control: concurrent streams per model and bounded waiting queues.
+ollama_max_concurrency_per_model = int(
+    os.getenv("OLLAMA_MAX_CONCURRENCY_PER_MODEL", "4")
+)
+# Per model overrides, e.g. "llama3:70b=1,phi3=8".
+ollama_model_concurrency = _model_overrides("OLLAMA_MODEL_CONCURRENCY", int)
+ollama_max_queue_per_model = int(os.getenv("OLLAMA_MAX_QUEUE_PER_MODEL", "32"))
+ollama_max_queue_per_session = int(os.getenv("OLLAMA_MAX_QUEUE_PER_SESSION", "2"))
+# Background work such as titles and summaries waits behind the chats.
+ollama_max_background_queue = int(os.getenv("OLLAMA_MAX_BACKGROUND_QUEUE", "8"))
+# Seconds sent in the Retry-After header when a queue is full.
+ollama_queue_retry_after = int(os.getenv("OLLAMA_QUEUE_RETRY_AFTER", "5"))
+
+database_url = os.getenv("DATABASE_URL", "sqlite:///databases/chat_storage.db")
+db_pool_size = int(os.getenv("DB_POOL_SIZE", "5"))
+db_max_overflow = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+db_workers = int(os.getenv("DB_WORKERS", str(db_pool_size + db_max_overflow)))
+
+# "default" keeps SQLite defaults, "production" enables WAL and tuned pragmas.
+storage_profile = os.getenv("STORAGE_PROFILE", "default")
+sqlite_mmap_size = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+sqlite_cache_size_kb = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+
+# Number of session id -> user primary key mappings kept in memory.
+user_cache_size = int(os.getenv("USER_CACHE_SIZE", "10000"))
+# Number of sessions whose channel list is kept in memory for /api/data.
+channel_cache_size = int(os.getenv("CHANNEL_CACHE_SIZE", "10000"))
+
+# Messages returned per /api/history page when the client does not ask for a
+# number; older ones are loaded as the user scrolls up.
+history_page_size = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+
+# "full" speaks the finished answer, "incremental" speaks it sentence by sentence
+# while it is generated.
+tts_mode = os.getenv("TTS_MODE", "full")
+# "edge" uses edge_tts, "fake" only waits and writes a placeholder file.
+tts_backend = os.getenv("TTS_BACKEND", "edge")
+tts_min_segment_chars = int(os.getenv("TTS_MIN_SEGMENT_CHARS", "40"))
+fake_tts_latency = float(os.getenv("FAKE_TTS_LATENCY", "0.3"))
+fake_tts_seconds_per_char = float(os.getenv("FAKE_TTS_SECONDS_PER_CHAR", "0.002"))
+# Synthesized audio is cached on disk by voice and text, up to this many MiB.
+# 0 disables the cache.
+tts_cache_max_mb = int(os.getenv("TTS_CACHE_MAX_MB", "512"))
+tts_cache_dir = os.getenv("TTS_CACHE_DIR", os.path.join("static", "audio", "tts"))
+
+# Speech recognition runs in a "thread" or "process" pool of STT_WORKERS
+# workers; at most STT_MAX_QUEUE further jobs may wait for a free worker.
+stt_executor = os.getenv("STT_EXECUTOR", "thread")
+stt_workers = int(os.getenv("STT_WORKERS", str(os.cpu_count() or 4)))
+stt_max_queue = int(os.getenv("STT_MAX_QUEUE", "16"))
+stt_timeout = float(os.getenv("STT_TIMEOUT", "30"))
+# "google" (online), "vosk" (offline, needs the vosk package and a model
+# directory in STT_VOSK_MODEL) or "fake".
+stt_backend = os.getenv("STT_BACKEND", "google")
+stt_vosk_model = os.getenv("STT_VOSK_MODEL", "")
+stt_fake_text = os.getenv("STT_FAKE_TEXT", "Hello, how are you?")
+stt_fake_latency = float(os.getenv("STT_FAKE_LATENCY", "0.1"))
+
+# Live voice input: RMS level that counts as speech, the silence that ends an
+# utterance, and the longest utterance accepted.
+voice_vad_threshold = int(os.getenv("VOICE_VAD_THRESHOLD", "500"))
+voice_end_silence_ms = int(os.getenv("VOICE_END_SILENCE_MS", "800"))
+voice_max_seconds = float(os.getenv("VOICE_MAX_SECONDS", "30"))
+# Wall-clock seconds a voice socket may take to deliver its utterance.
+voice_listen_timeout = float(os.getenv("VOICE_LISTEN_TIMEOUT", "60"))
+
+# Token budget of the history sent with each prompt, and the characters per
+# token used when a message's real token count is unknown. Both can be set per
+# model, e.g. CONTEXT_MODEL_MAX_TOKENS="llama3=8192" and
+# CONTEXT_MODEL_CHARS_PER_TOKEN="qwen2=3.2".
+context_max_tokens = int(os.getenv("CONTEXT_MAX_TOKENS", "2048"))
+context_model_max_tokens = _model_overrides("CONTEXT_MODEL_MAX_TOKENS", int)
+context_chars_per_token = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "4"))
+context_model_chars_per_token = _model_overrides("CONTEXT_MODEL_CHARS_PER_TOKEN", float)
+
+# Rolling summaries of long channels, made with SUMMARY_MODEL (disabled when
+# empty). Once the messages after the last summary exceed
+# SUMMARY_TRIGGER_TOKENS, all but the newest SUMMARY_KEEP_TOKENS of them are
+# folded into the summary.
+summary_model = os.getenv("SUMMARY_MODEL", "")
+summary_trigger_tokens = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "1536"))
+summary_keep_tokens = int(os.getenv("SUMMARY_KEEP_TOKENS", "512"))
+summary_max_words = int(os.getenv("SUMMARY_MAX_WORDS", "200"))
+
+# Ollama model that names new channels. When empty the first message is
+# summarized locally with sumy instead.
+title_model = os.getenv("TITLE_MODEL", "")
+
+# When the language detector, title summarizer, TTS client and STT backend are
+# loaded: "lazy" on first use, "background" in a task started with the server,
+# "eager" before the server accepts requests.
+startup_warmup = os.getenv("STARTUP_WARMUP", "background")
+
+# Format of /api/chat/ responses: "ndjson" typed events, or "legacy" text with
+# $[[...]] markers for old clients. Clients can pick one with the
+# `stream_format` form field. Tokens are coalesced into one event per
+# STREAM_FLUSH_MS, or sooner once STREAM_FLUSH_CHARS are buffered.
+chat_stream_format = os.getenv("CHAT_STREAM_FORMAT", "ndjson")
+stream_flush_ms = float(os.getenv("STREAM_FLUSH_MS", "50"))
+stream_flush_chars = int(os.getenv("STREAM_FLUSH_CHARS", "256"))
+
+# Send the duration of each stage of a chat turn to the client, as a
+# Server-Timing header and a "timing" stream event. Off unless set to 1.
+server_timing = os.getenv("SERVER_TIMING", "0") == "1"
+
+# Log file, rotated once it reaches LOG_MAX_BYTES with LOG_BACKUP_COUNT old
+# files kept. Chat text is logged as previews of LOG_PREVIEW_CHARS characters;
+# the full request and response of a LOG_PAYLOAD_SAMPLE_RATE fraction of turns
+# are logged too, up to LOG_PAYLOAD_MAX_CHARS each.
+log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+log_file = os.getenv("LOG_FILE", "server.log")
+log_max_bytes = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+log_backup_count = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+log_preview_chars = int(os.getenv("LOG_PREVIEW_CHARS", "120"))
+log_payload_sample_rate = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0"))
+log_payload_max_chars = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "65536"))
 
-ollama_url = f"{ollama_host}/api/chat"
-ollama_tags_url = os.getenv("OLLAMA_TAGS_URL", f"{ollama_host}/api/tags")
+# Seconds between the timer ticks that measure event loop lag for /metrics;
+# 0 turns the measurement off.
+event_loop_lag_interval = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.1"))
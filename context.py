@@ -0,0 +1,53 @@
+"""
+Builds the history window sent to the LLM. Messages are counted in tokens,
+using the count stored with each message or a characters-per-token estimate,
+and the window is filled from the newest message backwards until the model's
+budget is spent.
+"""
+
+import math
+
+from config import (
+    context_chars_per_token,
+    context_max_tokens,
+    context_model_chars_per_token,
+    context_model_max_tokens,
+)
+
+# Tokens a chat template spends on the role and separators of each message.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def max_context_tokens(model: str | None = None) -> int:
+    return context_model_max_tokens.get(model, context_max_tokens)
+
+
+def estimate_tokens(text: str, model: str | None = None) -> int:
+    chars_per_token = context_model_chars_per_token.get(model, context_chars_per_token)
+    return math.ceil(len(text) / chars_per_token)
+
+
+def build_context_window(rows, model: str | None = None, summary=None) -> list[dict]:
+    """
+    Take (role, content, token_count) rows newest first and return the
+    longest chronological tail that fits the model's token budget. Rows are
+    consumed lazily, so the caller's query stops at the first one that does
+    not fit. A `summary` row of the older history goes first and is paid for
+    before any message.
+    """
+    budget = max_context_tokens(model)
+    prefix = []
+    if summary is not None:
+        role, content, token_count = summary
+        budget -= token_count + MESSAGE_OVERHEAD_TOKENS
+        prefix.append({"role": role, "content": content})
+    window = []
+    for role, content, token_count in rows:
+        if token_count is None:
+            token_count = estimate_tokens(content, model)
+        budget -= token_count + MESSAGE_OVERHEAD_TOKENS
+        if budget < 0:
+            break
+        window.append({"role": role, "content": content})
+    window.reverse()
+    return prefix + window
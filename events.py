@@ -0,0 +1,130 @@
+"""
+Encoding of chat response events. The answer is produced as a stream of
+events, each a dict with a "type":
+
+    meta    channel_id, channel_name, resolved_text or queue_position
+    token   text of the answer
+    audio   audio_url with the segment `index`, or `final` for the whole answer
+    error   detail
+    timing  stages, the milliseconds spent in each (with SERVER_TIMING=1)
+    done    the turn was saved
+
+Over HTTP they are sent as newline-delimited JSON, or in the legacy text
+format with $[[...]] markers. Tokens that arrive within one flush window are
+merged into a single event.
+"""
+
+import asyncio
+import json
+import time
+from typing import AsyncIterator
+
+from config import stream_flush_chars, stream_flush_ms
+
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "legacy": "text/plain"}
+
+
+async def coalesce_tokens(
+    events: AsyncIterator[dict],
+    flush_ms: float = stream_flush_ms,
+    flush_chars: int = stream_flush_chars,
+) -> AsyncIterator[dict]:
+    """
+    Merge consecutive token events so at most one is sent per `flush_ms`.
+    A token after a quiet period goes out at once; the ones following it are
+    held until the window ends, `flush_chars` are buffered, or another event
+    type arrives.
+    """
+    if flush_ms <= 0:
+        async for event in events:
+            yield event
+        return
+
+    window = flush_ms / 1000
+    buffer = []
+    buffered_chars = 0
+    last_flush = float("-inf")
+    pending = None
+
+    def flush():
+        nonlocal buffer, buffered_chars, last_flush
+        event = {"type": "token", "text": "".join(buffer)}
+        buffer = []
+        buffered_chars = 0
+        last_flush = time.monotonic()
+        return event
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(anext(events))
+            timeout = None
+            if buffer:
+                timeout = max(0, last_flush + window - time.monotonic())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield flush()
+                continue
+
+            try:
+                event = pending.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+
+            if event["type"] != "token":
+                if buffer:
+                    yield flush()
+                yield event
+                continue
+
+            buffer.append(event["text"])
+            buffered_chars += len(event["text"])
+            if time.monotonic() - last_flush >= window or buffered_chars >= flush_chars:
+                yield flush()
+        if buffer:
+            yield flush()
+    finally:
+        if pending is not None:
+            # Cancelling the pending step lets the producer clean up.
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        await events.aclose()
+
+
+async def encode_ndjson(events: AsyncIterator[dict]) -> AsyncIterator[str]:
+    async for event in events:
+        yield json.dumps(event) + "\n"
+
+
+async def encode_legacy(events: AsyncIterator[dict]) -> AsyncIterator[str]:
+    """The text stream with $[[...]] markers read by older clients."""
+    first = True
+    async for event in events:
+        kind = event["type"]
+        if kind == "token":
+            yield event["text"]
+        elif kind == "error":
+            yield event["detail"]
+        elif kind == "meta":
+            fields = {key: value for key, value in event.items() if key != "type"}
+            chunk = f"$[[START_JSON]]{json.dumps(fields)}$[[END_JSON]]"
+            if first:
+                yield chunk + "\n"
+                yield "\n"
+            else:
+                yield chunk
+        elif kind == "audio" and event.get("final"):
+            fields = {
+                "audio_url": event["audio_url"],
+                "channel_id": event["channel_id"],
+            }
+            yield f"\n$[[AUDIO_DONE]]{json.dumps(fields)}$[[AUDIO_DONE]]"
+        elif kind == "audio":
+            fields = {"audio_url": event["audio_url"], "index": event["index"]}
+            yield f"$[[AUDIO_SEGMENT]]{json.dumps(fields)}$[[AUDIO_SEGMENT]]"
+        first = False
+
+
+STREAM_ENCODERS = {"ndjson": encode_ndjson, "legacy": encode_legacy}
@@ -0,0 +1,110 @@
+"""
+Logging setup. Records are put on a queue by the code that logs them and
+written to the rotating log file and stdout by a background thread, so a slow
+disk never stalls the event loop. Chat text is only logged as short redacted
+previews; full payloads are logged for a sample of turns when enabled.
+"""
+
+import atexit
+import json
+import logging
+import queue
+import random
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from config import (
+    log_backup_count,
+    log_file,
+    log_level,
+    log_max_bytes,
+    log_payload_max_chars,
+    log_payload_sample_rate,
+    log_preview_chars,
+)
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+_payload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log")
+
+# E-mail addresses, long digit runs such as phone or card numbers, and long
+# unbroken tokens such as API keys.
+REDACTIONS = (
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"), "<email>"),
+    (re.compile(r"\+?\d[\d -]{6,}\d"), "<number>"),
+    (re.compile(r"\b[A-Za-z0-9_\-]{32,}\b"), "<token>"),
+)
+
+
+def setup_logging() -> QueueListener:
+    """Route all records through a queue to the log file and stdout."""
+    file_handler = RotatingFileHandler(
+        log_file, maxBytes=log_max_bytes, backupCount=log_backup_count
+    )
+    stream_handler = logging.StreamHandler(sys.stdout)
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    listener = QueueListener(
+        records, file_handler, stream_handler, respect_handler_level=True
+    )
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(records)]
+    root.setLevel(log_level)
+    listener.start()
+    # Flush what is still queued when the process exits.
+    atexit.register(listener.stop)
+    return listener
+
+
+def setup_worker_logging():
+    """
+    Worker processes inherit the queue handler but not the thread draining
+    it, so they log straight to stdout; only the server writes the log file.
+    """
+    logging.basicConfig(
+        level=log_level, format=LOG_FORMAT, stream=sys.stdout, force=True
+    )
+
+
+def redact(text: str) -> str:
+    for pattern, replacement in REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def preview(text, limit: int = log_preview_chars) -> str:
+    """
+    A single-line, redacted rendering of at most `limit` characters of `text`
+    for logs. Only the head of the text is looked at, so a long text costs no
+    more than a short one.
+    """
+    text = str(text)
+    head = redact(" ".join(text[: 2 * limit].split()))
+    if len(text) <= 2 * limit and len(head) <= limit:
+        return head
+    return f"{head[:limit]}... ({len(text)} chars)"
+
+
+def sample_payload() -> bool:
+    """Whether this turn's full payload should be logged."""
+    return log_payload_sample_rate > 0 and random.random() < log_payload_sample_rate
+
+
+def _log_payload(label: str, value):
+    if not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False)
+    logging.info("%s: %s", label, preview(value, log_payload_max_chars))
+
+
+def log_payload(label: str, value):
+    """
+    Log `value`, a string or JSON data, redacted and capped at
+    LOG_PAYLOAD_MAX_CHARS. Payloads can be large, so they are serialized and
+    redacted on a separate thread.
+    """
+    _payload_executor.submit(_log_payload, label, value)
@@ -6,48 +6,106 @@ managing chat history, and generating audio responses using AI models.
 import asyncio
 import logging
 import os
-import sys
 import time
 import uuid
+from contextlib import aclosing, asynccontextmanager
 from typing import Optional
 
 import uvicorn
-from fastapi import Cookie, FastAPI, File, Form, HTTPException, UploadFile
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi import (
+    Cookie,
+    FastAPI,
+    File,
+    Form,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 from fastapi.staticfiles import StaticFiles
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("server.log"), logging.StreamHandler(sys.stdout)],
-)
+from logs import preview, setup_logging
+
+setup_logging()
 
 
 from ai import (
     extract_user_input_async,
     response_stream_generator,
 )
-from chat import chat_storage_manager
-from ollama import does_model_exist, ollama_models
+from chat import (
+    MAX_HISTORY_LENGTH,
+    chat_storage_manager,
+    engine,
+    init_schema,
+    run_db,
+    submit_db,
+)
+from config import (
+    chat_stream_format,
+    event_loop_lag_interval,
+    history_page_size,
+    server_timing,
+)
+from events import STREAM_ENCODERS, STREAM_MEDIA_TYPES, coalesce_tokens
+from metrics import StageTimer, monitor_event_loop_lag, render_metrics
+from ollama import (
+    close_http_session,
+    does_model_exist,
+    model_registry,
+    start_http_session,
+)
+from scheduler import chat_scheduler
+from speech import tts_cache
+from stt import stt_pool
+from summary import channel_summarizer
+from titles import start_naming_channel
+from voice import listen
+from warmup import start_warm_up
 
 os.makedirs("static/audio", exist_ok=True)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """Open shared clients on startup and release them on shutdown."""
+    await run_db(init_schema, engine)
+    if tts_cache is not None:
+        submit_db(tts_cache.load)
+    await start_http_session()
+    model_registry.start()
+    await start_warm_up()
+    lag_monitor = None
+    if event_loop_lag_interval > 0:
+        lag_monitor = asyncio.create_task(
+            monitor_event_loop_lag(event_loop_lag_interval)
+        )
+    yield
+    if lag_monitor is not None:
+        lag_monitor.cancel()
+    await channel_summarizer.stop()
+    await model_registry.stop()
+    await close_http_session()
+    stt_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
-@app.post("/api/chat/")
-async def chat_llm_api(
-    session_id: Optional[str] = Cookie(default=None),
-    channel_id: Optional[str] = Form(None),
-    file: Optional[UploadFile] = File(None),
-    text: Optional[str] = Form(None),
-    model: Optional[str] = Form(None),
-):
-    """Handles chat requests and manages chat history."""
-    if channel_id and not chat_storage_manager.does_channel_exist(
-        session_id, channel_id
+async def _check_chat_request(session_id, channel_id, model):
+    if channel_id and not await run_db(
+        chat_storage_manager.does_channel_exist, session_id, channel_id
     ):
         logging.error(
             "Channel %s does not exist for session %s.", channel_id, session_id
@@ -56,15 +114,93 @@ async def chat_llm_api(
     if not model:
         raise HTTPException(status_code=400, detail="Model parameter missing")
 
-    if not does_model_exist(model):
+    if not await does_model_exist(model):
         raise HTTPException(status_code=404, detail="Model does not exist")
 
-    is_channel_created = False
 
+class ChatStreamingResponse(StreamingResponse):
+    """
+    Streams a chat answer and gives its place in the model queue back when
+    the response ends, however it ends, even if the body was never started.
+    """
+
+    def __init__(self, content, ticket, **kwargs):
+        super().__init__(content, **kwargs)
+        self.ticket = ticket
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.ticket.release()
+
+
+async def _start_chat(session_id, channel_id, user_input, model, timer):
+    """
+    Create the channel if needed and load the history for the LLM. Returns
+    the channel id, history and, for a new channel, its provisional name and
+    the task naming it.
+    """
+    new_channel = None
+    if not channel_id:
+        channel_id = str(uuid.uuid4())
+        channel = await run_db(
+            chat_storage_manager.create_channel, session_id, channel_id, user_input
+        )
+        new_channel = {
+            "name": channel.channel_name,
+            "title": start_naming_channel(session_id, channel_id, user_input),
+        }
+        chat_history = []
+    else:
+        step_start_time = time.time()
+        with timer.stage("history_load"):
+            chat_history = await run_db(
+                chat_storage_manager.load_chat_history,
+                session_id,
+                channel_id,
+                True,
+                model=model,
+            )
+
+        logging.info(
+            "Loaded chat history for channel %s. Time taken: %.2f seconds",
+            channel_id,
+            time.time() - step_start_time,
+        )
+
+    chat_history.append({"role": "user", "content": user_input})
+    return channel_id, chat_history, new_channel
+
+
+@app.post("/api/chat/")
+async def chat_llm_api(
+    request: Request,
+    session_id: Optional[str] = Cookie(default=None),
+    channel_id: Optional[str] = Form(None),
+    file: Optional[UploadFile] = File(None),
+    text: Optional[str] = Form(None),
+    model: Optional[str] = Form(None),
+    stream_format: Optional[str] = Form(None),
+):
+    """
+    Handles chat requests and manages chat history. The answer is streamed as
+    newline-delimited JSON events, or in the legacy text format when
+    `stream_format` or CHAT_STREAM_FORMAT is "legacy".
+    """
+    stream_format = stream_format or chat_stream_format
+    if stream_format not in STREAM_ENCODERS:
+        raise HTTPException(status_code=400, detail="Unknown stream format")
+    await _check_chat_request(session_id, channel_id, model)
+    # A full queue is refused before any speech recognition work.
+    chat_scheduler.check(model, session_id)
+
+    timer = StageTimer(model)
     step_start_time = time.time()
     is_file_uploaded = file is not None and not text
-    user_input = await extract_user_input_async(file, text)
-    logging.info("Input reached: %s", user_input)
+    with timer.stage("input"):
+        user_input = await extract_user_input_async(file, text)
+    logging.info("Input reached: %s", preview(user_input))
 
     if not user_input:
         logging.warning("Failed to extract user input for session %s.", session_id)
@@ -74,48 +210,162 @@ async def chat_llm_api(
         )
     logging.info(
         "Extracted user input: %s. Time taken: %.2f seconds",
-        user_input,
+        preview(user_input),
         time.time() - step_start_time,
     )
 
-    if not channel_id:
-        channel_id = str(uuid.uuid4())
-        is_channel_created = True
-        chat_storage_manager.create_channel(session_id, channel_id, text)
-
-    step_start_time = time.time()
-    chat_history = chat_storage_manager.load_chat_history(session_id, channel_id, True)
+    # The model slot is taken only once the input is ready, and before the
+    # channel is created so a refused request leaves nothing behind.
+    ticket = chat_scheduler.enqueue(model, session_id)
+    try:
+        channel_id, chat_history, new_channel = await _start_chat(
+            session_id, channel_id, user_input, model, timer
+        )
+    except BaseException:
+        ticket.release()
+        raise
 
-    logging.info(
-        "Loaded chat history for channel %s. Time taken: %.2f seconds",
+    events = response_stream_generator(
         channel_id,
-        time.time() - step_start_time,
+        session_id,
+        user_input,
+        is_file_uploaded,
+        chat_history,
+        model,
+        ticket,
+        request,
+        new_channel,
+        timer,
     )
-
-    chat_history.append({"role": "user", "content": user_input})
-    chat_history = chat_history[::-1] if not is_channel_created else chat_history
-    return StreamingResponse(
-        response_stream_generator(
-            channel_id, session_id, user_input, is_file_uploaded, chat_history, model
-        ),
-        media_type="text/plain",
+    headers = {"Server-Timing": timer.server_timing()} if server_timing else None
+    return ChatStreamingResponse(
+        STREAM_ENCODERS[stream_format](coalesce_tokens(events)),
+        ticket,
+        media_type=STREAM_MEDIA_TYPES[stream_format],
+        headers=headers,
     )
 
 
+@app.websocket("/ws/voice")
+async def voice_chat_ws(
+    websocket: WebSocket,
+    channel_id: Optional[str] = None,
+    model: Optional[str] = None,
+):
+    """
+    Voice chat over a WebSocket. The client streams recording chunks as
+    binary messages; once the end of speech is detected the transcript is
+    sent back and the answer is streamed as the same events, one per message,
+    as the /api/chat/ response body.
+    """
+    session_id = websocket.cookies.get("session_id")
+    await websocket.accept()
+    try:
+        await _check_chat_request(session_id, channel_id, model)
+        # A full queue is refused before the user starts talking.
+        chat_scheduler.check(model, session_id)
+        step_start_time = time.time()
+        user_input = await listen(websocket)
+        if not user_input:
+            raise HTTPException(status_code=400, detail="No speech detected.")
+        logging.info(
+            "Recognized live input: %s. Time taken: %.2f seconds",
+            preview(user_input),
+            time.time() - step_start_time,
+        )
+        await websocket.send_json({"type": "transcript", "text": user_input})
+
+        ticket = chat_scheduler.enqueue(model, session_id)
+        try:
+            # The utterance is not timed; it lasts as long as the user talks.
+            timer = StageTimer(model)
+            channel_id, chat_history, new_channel = await _start_chat(
+                session_id, channel_id, user_input, model, timer
+            )
+            events = response_stream_generator(
+                channel_id,
+                session_id,
+                user_input,
+                False,
+                chat_history,
+                model,
+                ticket,
+                new_channel=new_channel,
+                timer=timer,
+            )
+            async with aclosing(coalesce_tokens(events)) as stream:
+                async for event in stream:
+                    await websocket.send_json(event)
+        finally:
+            ticket.release()
+        await websocket.close()
+    except HTTPException as e:
+        await websocket.send_json(
+            {"type": "error", "status": e.status_code, "detail": e.detail}
+        )
+        await websocket.close()
+    except WebSocketDisconnect:
+        logging.info("Voice client disconnected for session %s", session_id)
+    except Exception as e:
+        logging.exception("Voice chat failed for session %s", session_id)
+        await websocket.send_json({"type": "error", "status": 500, "detail": str(e)})
+        await websocket.close(code=1011)
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match header lists `etag`."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
 @app.get("/api/history/{channel_id}")
 async def get_history(
-    channel_id: str, session_id: Optional[str] = Cookie(default=None)
+    channel_id: str,
+    request: Request,
+    limit: int = Query(default=history_page_size, ge=1, le=MAX_HISTORY_LENGTH),
+    before: Optional[int] = None,
+    since: Optional[int] = None,
+    session_id: Optional[str] = Cookie(default=None),
 ):
-    """Get chat history for a given channel ID."""
+    """
+    Get a page of the chat history of a channel: the latest `limit` messages,
+    the ones before sequence `before` or the ones after sequence `since`.
+    An unchanged page is answered with 304.
+    """
     if not session_id:
         logging.error("Session ID is missing in request to get history.")
         raise HTTPException(status_code=400, detail="Session id missing")
     if not channel_id:
         logging.error("Channel ID is missing in request to get history.")
         raise HTTPException(status_code=400, detail="Channel id missing")
-    chat_history = chat_storage_manager.load_chat_history(session_id, channel_id)
+    if before is not None and since is not None:
+        raise HTTPException(
+            status_code=400, detail="Only one of before and since can be given"
+        )
+
+    version = await run_db(
+        chat_storage_manager.get_history_version, session_id, channel_id
+    )
+    headers = {
+        "ETag": f'W/"{version}.{limit}.{before}.{since}"',
+        "Cache-Control": "private, no-cache",
+    }
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    page = await run_db(
+        chat_storage_manager.load_history_page,
+        session_id,
+        channel_id,
+        limit,
+        before=before,
+        since=since,
+    )
     logging.info("Retrieved history for channel %s.", channel_id)
-    return {"history": chat_history}
+    return JSONResponse(page, headers=headers)
 
 
 @app.delete("/api/history/{channel_id}/")
@@ -127,7 +377,7 @@ async def delete_history(
     if not session_id:
         logging.error("Session ID is missing in request to delete history.")
         raise HTTPException(status_code=400, detail="Session id missing")
-    chat_storage_manager.delete_channel(session_id, channel_id)
+    await run_db(chat_storage_manager.delete_channel, session_id, channel_id)
     logging.info("Deleted history for channel %s.", channel_id)
     return {"success": "true", "message": "History deleted successfully."}
 
@@ -138,17 +388,53 @@ async def delete_all_history(session_id: Optional[str] = Cookie(default=None)):
     if not session_id:
         logging.error("Session ID is missing in request to delete all history.")
         raise HTTPException(status_code=400, detail="Session id missing")
-    chat_storage_manager.delete_all_channels(session_id)
+    await run_db(chat_storage_manager.delete_all_channels, session_id)
     logging.info("Deleted all history for session %s.", session_id)
     return {"success": "true", "message": "History deleted successfully."}
 
 
 @app.get("/api/data")
-async def get_init_data(session_id: Optional[str] = Cookie(default=None)):
+async def get_init_data(
+    request: Request,
+    since_version: Optional[int] = None,
+    session_id: Optional[str] = Cookie(default=None),
+):
+    """
+    The session's channels and the available models. With `since_version`,
+    the version of a list received earlier, only the channels changed and
+    deleted since then are sent when they are known. An unchanged answer is
+    sent as 304.
+    """
     user_id = session_id
-    channels = chat_storage_manager.get_channels(user_id)
-    models = ollama_models if ollama_models is not None else []
-    return {"channels": channels, "models": models}
+    data = await run_db(chat_storage_manager.get_channel_list, user_id, since_version)
+    headers = {
+        "ETag": f'W/"{data["version"]}.{model_registry.version}.{since_version}"',
+        "Cache-Control": "private, no-cache",
+    }
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    data["models"] = model_registry.models
+    return JSONResponse(data, headers=headers)
+
+
+@app.get("/api/tts/metrics")
+async def get_tts_metrics():
+    if tts_cache is None:
+        return {"cache": None}
+    return {"cache": tts_cache.stats()}
+
+
+@app.get("/api/stt/metrics")
+async def get_stt_metrics():
+    return stt_pool.metrics()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Stage latency histograms in the Prometheus text format."""
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 @app.middleware("http")
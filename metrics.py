@@ -0,0 +1,152 @@
+"""
+Latency histograms of the stages of a chat turn, served in the Prometheus
+text format on /metrics. Each turn is timed by a StageTimer, which also keeps
+its own durations for Server-Timing headers and the timing stream event.
+"""
+
+import asyncio
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a cached lookup to a long generation.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def percentile(samples, pct) -> float:
+    """The nearest-rank `pct` percentile of `samples`, or 0.0 if empty."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class Histogram:
+    """A cumulative histogram per combination of label values."""
+
+    def __init__(self, name: str, documentation: str, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # label values -> [count per bucket, sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = sorted(
+                (key, list(counts), total, count)
+                for key, (counts, total, count) in self._series.items()
+            )
+        for key, counts, total, count in series:
+            labels = ",".join(
+                f'{name}="{_escape(value)}"'
+                for name, value in zip(self.labelnames, key)
+            )
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_bound(bound)}"'
+                bucket_labels = f"{labels},{le}" if labels else le
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            series_labels = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{series_labels} {total}")
+            lines.append(f"{self.name}_count{series_labels} {count}")
+        return lines
+
+
+stage_seconds = Histogram(
+    "promptlama_stage_seconds",
+    "Duration of each stage of a chat turn.",
+    ("stage", "model"),
+    LATENCY_BUCKETS,
+)
+tokens_per_second = Histogram(
+    "promptlama_ollama_tokens_per_second",
+    "Generation speed of Ollama answers.",
+    ("model",),
+    RATE_BUCKETS,
+)
+event_loop_lag_seconds = Histogram(
+    "promptlama_event_loop_lag_seconds",
+    "How late the event loop woke up a periodic timer.",
+    (),
+    LAG_BUCKETS,
+)
+HISTOGRAMS = (stage_seconds, tokens_per_second, event_loop_lag_seconds)
+
+
+def render_metrics() -> str:
+    return "\n".join(line for h in HISTOGRAMS for line in h.render()) + "\n"
+
+
+async def monitor_event_loop_lag(interval: float):
+    """
+    Sleep for `interval` seconds in a loop and record how much longer each
+    sleep took, which is the time some callback blocked the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.observe(max(0.0, loop.time() - started - interval))
+
+
+class StageTimer:
+    """Records the stages of one chat turn for `model`."""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.durations: dict[str, float] = {}
+
+    def record(self, stage: str, seconds: float):
+        stage_seconds.observe(seconds, stage=stage, model=self.model)
+        self.durations[stage] = self.durations.get(stage, 0) + seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record_rate(self, tokens: int, seconds: float):
+        if tokens and seconds > 0:
+            tokens_per_second.observe(tokens / seconds, model=self.model)
+
+    def milliseconds(self) -> dict[str, float]:
+        return {stage: round(s * 1000, 1) for stage, s in self.durations.items()}
+
+    def server_timing(self) -> str:
+        """The recorded stages as a Server-Timing header value."""
+        return ", ".join(
+            f"{stage};dur={ms}" for stage, ms in self.milliseconds().items()
+        )
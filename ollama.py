@@ -1,34 +1,272 @@
+import asyncio
 import json
 import logging
+import time
 
 import aiohttp
-import requests
 from fastapi import HTTPException
 
-from config import ollama_tags_url, ollama_url
+from config import (
+    ollama_connect_timeout,
+    ollama_eject_seconds,
+    ollama_hosts,
+    ollama_keepalive_timeout,
+    ollama_max_failures,
+    ollama_models_miss_refresh_interval,
+    ollama_models_refresh_interval,
+    ollama_pool_size,
+    ollama_read_timeout,
+)
 
-ollama_models = []
+_http_session: aiohttp.ClientSession | None = None
 
 
-def list_ollama_models():
-    """List available models from the Ollama server."""
-    global ollama_models
+def _create_http_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=ollama_pool_size,
+        keepalive_timeout=ollama_keepalive_timeout,
+        enable_cleanup_closed=True,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=None,
+        connect=ollama_connect_timeout,
+        sock_read=ollama_read_timeout,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
 
+
+async def start_http_session():
+    """Open the shared HTTP client used for all Ollama traffic."""
+    global _http_session
+
+    if _http_session is None or _http_session.closed:
+        _http_session = _create_http_session()
+
+
+async def close_http_session():
+    """Close the shared HTTP client and its pooled connections."""
+    global _http_session
+
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Return the shared HTTP client. It is normally opened in the application
+    lifespan, but is created on first use if that did not happen.
+    """
+    global _http_session
+
+    if _http_session is None or _http_session.closed:
+        _http_session = _create_http_session()
+    return _http_session
+
+
+class OllamaBackend:
+    """One Ollama server together with its models and routing state."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.chat_url = f"{host}/api/chat"
+        self.tags_url = f"{host}/api/tags"
+        self.models: dict[str, dict] = {}
+        self.in_flight = 0
+        self.last_picked = 0.0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def record_failure(self):
+        """Counts a failed request and ejects the host after too many in a row."""
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= ollama_max_failures:
+            self.ejected_until = time.monotonic() + ollama_eject_seconds
+            logging.warning(
+                "Ejecting Ollama host %s for %.0f seconds after %d failures",
+                self.host,
+                ollama_eject_seconds,
+                self.consecutive_failures,
+            )
+
+
+class ModelRegistry:
+    """
+    Caches the model catalog of every configured Ollama server. Catalogs are
+    refreshed in the background and indexed by model name, and an unknown name
+    triggers one on-demand refresh so newly pulled models work without a
+    restart.
+    """
+
+    def __init__(
+        self,
+        hosts: list[str],
+        refresh_interval: float,
+        miss_refresh_interval: float,
+    ):
+        self.backends = [OllamaBackend(host) for host in hosts]
+        self.refresh_interval = refresh_interval
+        self.miss_refresh_interval = miss_refresh_interval
+        self._models: dict[str, dict] = {}
+        # Incremented whenever the model list changes.
+        self.version = 0
+        self._last_refresh = 0.0
+        self._refresh_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def models(self) -> list[dict]:
+        return list(self._models.values())
+
+    async def _refresh_backend(self, backend: OllamaBackend) -> bool:
+        try:
+            async with get_http_session().get(backend.tags_url) as response:
+                if response.status != 200:
+                    logging.error(
+                        "Failed to fetch models from %s. Status code: %s",
+                        backend.host,
+                        response.status,
+                    )
+                    backend.record_failure()
+                    return False
+                data = await response.json()
+        except Exception as e:
+            logging.error(
+                "An error occured while fetching ollama models from %s: %s",
+                backend.host,
+                e,
+            )
+            backend.record_failure()
+            return False
+
+        backend.models = {model["name"]: model for model in data.get("models", [])}
+        backend.record_success()
+        return True
+
+    async def refresh(self) -> bool:
+        """Fetch all model lists, returning False if no server could be reached."""
+        started = time.monotonic()
+        async with self._refresh_lock:
+            if self._last_refresh > started:
+                # Another caller refreshed while we were waiting for the lock.
+                return True
+            results = await asyncio.gather(
+                *(self._refresh_backend(backend) for backend in self.backends)
+            )
+
+            models = {}
+            for backend in self.backends:
+                for name, model in backend.models.items():
+                    models.setdefault(name, model)
+            if models != self._models:
+                self._models = models
+                self.version += 1
+            self._last_refresh = time.monotonic()
+            logging.info("Fetched models: %s", list(self._models))
+            return any(results)
+
+    async def has_model(self, name: str) -> bool:
+        if name in self._models:
+            return True
+        if time.monotonic() - self._last_refresh >= self.miss_refresh_interval:
+            await self.refresh()
+        return name in self._models
+
+    def pick_backend(self, model: str, exclude=()) -> OllamaBackend | None:
+        """
+        Picks the backend with the fewest in-flight streams among the healthy
+        ones that have `model`. Ejected backends are only used when no healthy
+        one has the model.
+        """
+        candidates = [
+            backend
+            for backend in self.backends
+            if model in backend.models and backend not in exclude
+        ]
+        pool = [backend for backend in candidates if backend.healthy] or candidates
+        if not pool:
+            return None
+        backend = min(pool, key=lambda b: (b.in_flight, b.last_picked))
+        backend.last_picked = time.monotonic()
+        return backend
+
+    async def _refresh_forever(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        """Start refreshing the catalogs in the background."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+model_registry = ModelRegistry(
+    ollama_hosts, ollama_models_refresh_interval, ollama_models_miss_refresh_interval
+)
+
+
+async def _close_when_set(event: asyncio.Event, response: aiohttp.ClientResponse):
+    await event.wait()
+    response.close()
+
+
+async def _read_chat_stream(backend, response, cancel_event):
+    """
+    Yield the JSON chunks of a streaming chat response. Setting
+    `cancel_event` closes the connection, which makes Ollama stop generating.
+    """
+    closer = None
+    if cancel_event is not None:
+        closer = asyncio.create_task(_close_when_set(cancel_event, response))
     try:
-        response = requests.get(ollama_tags_url, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            models = data.get("models", [])
-            ollama_models = models
-            logging.info("Fetched models: %s", ollama_models)
-        return []
-    except Exception as e:
-        logging.error(e)
-        pass
+        async for line in response.content:
+            try:
+                line = line.decode("utf-8").strip()
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                yield chunk
+            except json.JSONDecodeError as e:
+                logging.error(f"JSONDecodeError: {e} - Line: {line}")
+            except Exception as e:
+                logging.error(f"Unexpected error: {e}")
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        if cancel_event is not None and cancel_event.is_set():
+            logging.info("Cancelled Ollama request to %s", backend.host)
+            return
+        backend.record_failure()
+        raise
+    finally:
+        if closer is not None:
+            closer.cancel()
 
 
-async def ask_ollama_stream(model: str, chat_history):
-    """Send a request to the Ollama server and stream the response."""
+async def ask_ollama_stream(
+    model: str, chat_history, cancel_event: asyncio.Event | None = None
+):
+    """
+    Send a request to the least busy Ollama server that has the model and
+    stream the response. Servers that cannot be connected to are skipped.
+    Setting `cancel_event` aborts the upstream request.
+    """
 
     if not chat_history:
         raise HTTPException(
@@ -40,37 +278,85 @@ async def ask_ollama_stream(model: str, chat_history):
 
     payload = {"model": model, "stream": True, "messages": chat_history}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(ollama_url, json=payload) as response:
-            if response.status == 200:
-                async for line in response.content:
-                    try:
-                        line = line.decode("utf-8").strip()
-                        if not line:
-                            continue
-                        chunk = json.loads(line)
+    tried = set()
+    while cancel_event is None or not cancel_event.is_set():
+        backend = model_registry.pick_backend(model, exclude=tried)
+        if backend is None:
+            logging.error("No Ollama server available for model %s", model)
+            yield "Failed to get response from Ollama"
+            return
+        tried.add(backend)
+
+        backend.in_flight += 1
+        try:
+            try:
+                response = await get_http_session().post(backend.chat_url, json=payload)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                logging.warning("Could not reach Ollama at %s: %s", backend.host, e)
+                backend.record_failure()
+                continue
+
+            async with response:
+                if response.status == 200:
+                    backend.record_success()
+                    async for chunk in _read_chat_stream(
+                        backend, response, cancel_event
+                    ):
                         yield chunk
-                    except json.JSONDecodeError as e:
-                        logging.error(f"JSONDecodeError: {e} - Line: {line}")
-                    except Exception as e:
-                        logging.error(f"Unexpected error: {e}")
-            else:
-                logging.error(
-                    f"Failed to get response from Ollama. Status code: {response.status}"
-                )
-                logging.error(f"Response content: {await response.text()}")
-                yield "Failed to get response from Ollama"
-
-
-def does_model_exist(model_name: str) -> bool:
-    global ollama_models
-    for model in ollama_models:
-        if model["name"] == model_name:
-            return True
-    return False
+                else:
+                    if response.status >= 500:
+                        backend.record_failure()
+                    logging.error(
+                        f"Failed to get response from Ollama at {backend.host}. "
+                        f"Status code: {response.status}"
+                    )
+                    logging.error(f"Response content: {await response.text()}")
+                    yield "Failed to get response from Ollama"
+            return
+        finally:
+            backend.in_flight -= 1
+
+
+async def ask_ollama(model: str, messages) -> str | None:
+    """
+    Send a non-streaming chat request for background work and return the
+    answer, or None when no server could answer it.
+    """
+    payload = {"model": model, "stream": False, "messages": messages}
+
+    tried = set()
+    while True:
+        backend = model_registry.pick_backend(model, exclude=tried)
+        if backend is None:
+            logging.error("No Ollama server available for model %s", model)
+            return None
+        tried.add(backend)
+
+        backend.in_flight += 1
+        try:
+            async with get_http_session().post(
+                backend.chat_url, json=payload
+            ) as response:
+                if response.status != 200:
+                    if response.status >= 500:
+                        backend.record_failure()
+                    logging.error(
+                        "Failed to get response from Ollama at %s. Status code: %s",
+                        backend.host,
+                        response.status,
+                    )
+                    continue
+                data = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning("Could not reach Ollama at %s: %s", backend.host, e)
+            backend.record_failure()
+            continue
+        finally:
+            backend.in_flight -= 1
+
+        backend.record_success()
+        return data.get("message", {}).get("content", "")
 
 
-try:
-    list_ollama_models()
-except Exception as e:
-    logging.error("An error occured while fetching ollama models: %s", e)
+async def does_model_exist(model_name: str) -> bool:
+    return await model_registry.has_model(model_name)
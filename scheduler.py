@@ -0,0 +1,234 @@
+"""
+Admission control in front of Ollama. Every model gets a concurrency limit
+and a bounded FIFO queue; a session may only hold a few queued requests so one
+user cannot fill the queue for everyone else. Background work has a queue of
+its own that is only served while no chat is waiting.
+"""
+
+import asyncio
+import logging
+from collections import Counter, deque
+
+from fastapi import HTTPException
+
+from config import (
+    ollama_max_background_queue,
+    ollama_max_concurrency_per_model,
+    ollama_max_queue_per_model,
+    ollama_max_queue_per_session,
+    ollama_model_concurrency,
+    ollama_queue_retry_after,
+)
+
+_WAITING = "waiting"
+_GRANTED = "granted"
+_RELEASED = "released"
+# Session id of the tickets in the background queue.
+BACKGROUND_SESSION = "background"
+
+
+class ChatTicket:
+    """
+    A place in a model queue. `position` is 0 when the request could start
+    right away, otherwise the number of requests that were ahead of it plus
+    one. Use it as an async context manager around the Ollama call. Tickets
+    must be released on the event loop that took them.
+    """
+
+    def __init__(self, queue, session_id: str, position: int, background: bool = False):
+        self._queue = queue
+        self.session_id = session_id
+        self.position = position
+        self.background = background
+        self._state = _GRANTED if position == 0 else _WAITING
+        self._future = None
+        if self._state == _WAITING:
+            self._future = asyncio.get_running_loop().create_future()
+
+    async def wait(self):
+        """Wait until the request may be sent to Ollama."""
+        if self._future is not None:
+            await asyncio.shield(self._future)
+
+    def release(self):
+        """Free the slot, or leave the queue if the slot was never granted."""
+        if self._state == _GRANTED:
+            self._state = _RELEASED
+            self._queue._release()
+        elif self._state == _WAITING:
+            self._state = _RELEASED
+            self._queue._cancel(self)
+
+    async def __aenter__(self):
+        try:
+            await self.wait()
+        except BaseException:
+            self.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class ModelQueue:
+    """The running requests and the waiting line of one model."""
+
+    def __init__(
+        self, limit: int, max_queue: int, max_per_session: int, max_background: int
+    ):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_per_session = max_per_session
+        self.max_background = max_background
+        self.active = 0
+        self._waiters = deque()
+        self._background = deque()
+        self._per_session = Counter()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters) + len(self._background)
+
+    def check(self, session_id: str):
+        """Raise the 429 that `enqueue` would raise, without taking a place."""
+        if self.active < self.limit and not self.queued:
+            return
+        if (
+            len(self._waiters) >= self.max_queue
+            or self._per_session[session_id] >= self.max_per_session
+        ):
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests are waiting for this model.",
+                headers={"Retry-After": str(ollama_queue_retry_after)},
+            )
+
+    def enqueue(self, session_id: str) -> ChatTicket:
+        if self.active < self.limit and not self.queued:
+            self.active += 1
+            return ChatTicket(self, session_id, 0)
+
+        self.check(session_id)
+        ticket = ChatTicket(self, session_id, len(self._waiters) + 1)
+        self._waiters.append(ticket)
+        self._per_session[session_id] += 1
+        return ticket
+
+    def enqueue_background(self) -> ChatTicket:
+        if self.active < self.limit and not self.queued:
+            self.active += 1
+            return ChatTicket(self, BACKGROUND_SESSION, 0, background=True)
+
+        if len(self._background) >= self.max_background:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many background requests are waiting for this model.",
+                headers={"Retry-After": str(ollama_queue_retry_after)},
+            )
+
+        ticket = ChatTicket(self, BACKGROUND_SESSION, self.queued + 1, background=True)
+        self._background.append(ticket)
+        return ticket
+
+    def _release(self):
+        self.active -= 1
+        self._wake()
+
+    def _cancel(self, ticket: ChatTicket):
+        try:
+            if ticket.background:
+                self._background.remove(ticket)
+            else:
+                self._waiters.remove(ticket)
+        except ValueError:
+            return
+        self._forget(ticket)
+
+    def _forget(self, ticket: ChatTicket):
+        if ticket.background:
+            return
+        self._per_session[ticket.session_id] -= 1
+        if self._per_session[ticket.session_id] <= 0:
+            del self._per_session[ticket.session_id]
+
+    def _wake(self):
+        while self.queued and self.active < self.limit:
+            ticket = (self._waiters or self._background).popleft()
+            self._forget(ticket)
+            self.active += 1
+            ticket._state = _GRANTED
+            if not ticket._future.done():
+                ticket._future.set_result(None)
+
+
+class ChatScheduler:
+    """Hands out tickets from one ModelQueue per model."""
+
+    def __init__(
+        self,
+        default_limit: int,
+        max_queue: int,
+        max_per_session: int,
+        max_background: int,
+        model_limits: dict[str, int] | None = None,
+    ):
+        self.default_limit = default_limit
+        self.max_queue = max_queue
+        self.max_per_session = max_per_session
+        self.max_background = max_background
+        self.model_limits = model_limits or {}
+        self._queues: dict[str, ModelQueue] = {}
+
+    def _queue_for(self, model: str) -> ModelQueue:
+        queue = self._queues.get(model)
+        if queue is None:
+            limit = self.model_limits.get(model, self.default_limit)
+            queue = ModelQueue(
+                limit, self.max_queue, self.max_per_session, self.max_background
+            )
+            self._queues[model] = queue
+        return queue
+
+    def check(self, model: str, session_id: str):
+        """
+        Refuse a chat request early with a 429 HTTPException when `enqueue`
+        would refuse it now. Nothing is reserved; the place is taken by
+        `enqueue` once the request is ready to be sent.
+        """
+        self._queue_for(model).check(session_id)
+
+    def enqueue(self, model: str, session_id: str) -> ChatTicket:
+        """
+        Reserve a place for a chat request, raising a 429 HTTPException when
+        the model's queue or the session's share of it is full.
+        """
+        ticket = self._queue_for(model).enqueue(session_id)
+        if ticket.position:
+            logging.info(
+                "Queued request for model %s at position %d", model, ticket.position
+            )
+        return ticket
+
+    def background(self, model: str) -> ChatTicket:
+        """
+        Reserve a place for background work such as titles and summaries. It
+        only gets a slot while no chat is waiting for the model, and a 429
+        HTTPException is raised when the background queue is full.
+        """
+        return self._queue_for(model).enqueue_background()
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            model: {"active": queue.active, "queued": queue.queued}
+            for model, queue in self._queues.items()
+        }
+
+
+chat_scheduler = ChatScheduler(
+    ollama_max_concurrency_per_model,
+    ollama_max_queue_per_model,
+    ollama_max_queue_per_session,
+    ollama_max_background_queue,
+    ollama_model_concurrency,
+)
@@ -1,45 +1,326 @@
+import array
+import asyncio
+import hashlib
+import itertools
 import logging
+import math
 import os
 import re
-import subprocess
+import tempfile
+import threading
+import time
 import uuid
+from collections import OrderedDict
 
-import edge_tts
-import speech_recognition as sr
 from fastapi import HTTPException
 
+from chat import chat_storage_manager, submit_db
+from config import (
+    fake_tts_latency,
+    fake_tts_seconds_per_char,
+    tts_backend,
+    tts_cache_dir,
+    tts_cache_max_mb,
+)
+from logs import preview
+from stt import PCM_SAMPLE_RATE, recognize, stt_pool
+
 
 def clean_text_for_tts(text: str) -> str:
     """Clean the text for TTS processing."""
     return re.sub(r"[^\w\s,.!?'-]", "", text)
 
 
+VOICE_MAP = {
+    "en": "en-US-AriaNeural",
+    "fr": "fr-FR-DeniseNeural",
+    "de": "de-DE-KatjaNeural",
+    "es": "es-ES-ElviraNeural",
+    "it": "it-IT-ElsaNeural",
+    "pt": "pt-PT-FernandaNeural",
+    "ru": "ru-RU-DariyaNeural",
+    "zh": "zh-CN-XiaoxiaoNeural",
+    "ja": "ja-JP-NanamiNeural",
+    "ko": "ko-KR-SunHiNeural",
+    "tr": "tr-TR-EmelNeural",
+}
+
+# Sentence ends: terminal punctuation followed by whitespace, or a line break.
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+
+def voice_for_language(lang: str) -> str:
+    return VOICE_MAP.get(lang, "en-US-AriaNeural")
+
+
+async def _synthesize_edge(text: str, voice: str, output_file_path: str):
+    import edge_tts
+
+    communicate = edge_tts.Communicate(text, voice)
+    await communicate.save(output_file_path)
+
+
+async def _synthesize_fake(text: str, voice: str, output_file_path: str):
+    """Stand-in for edge_tts that only takes time, for tests and benchmarks."""
+    await asyncio.sleep(fake_tts_latency + fake_tts_seconds_per_char * len(text))
+    with open(output_file_path, "wb") as f:
+        f.write(f"{voice}:{text}".encode("utf-8"))
+
+
+TTS_BACKENDS = {"edge": _synthesize_edge, "fake": _synthesize_fake}
+
+
+# Files looked up in or dropped from the history at once when pruning.
+PRUNE_BATCH = 100
+
+
+def _join_audio(paths, output_file_path: str):
+    """MP3 frames are self-contained, so joining the files is enough."""
+    with open(output_file_path, "wb") as output:
+        for path in paths:
+            with open(path, "rb") as segment:
+                output.write(segment.read())
+
+
+class TTSCache:
+    """
+    Synthesized audio stored on disk under the hash of its voice and cleaned
+    text, so repeated answers are not sent to the TTS backend again, and the
+    combined audio of whole answers. All files count against `max_bytes`.
+    When the cache is full the least recently used files that no stored
+    message points to are deleted first; only then is the oldest history
+    audio deleted and dropped from its messages.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # key -> size, least recently used first. Files found in the history
+        # while pruning move to `_history`; `_bytes` is the total of both.
+        self._entries = OrderedDict()
+        self._history = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pruning = False
+        self._pending: dict[str, asyncio.Future] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self):
+        """
+        Index the files left by a previous run as the least recently used
+        ones. The directory can be large, so this runs in the background.
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".mp3"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        with self._lock:
+            for _, key, size in sorted(files, reverse=True):
+                if key in self._entries or key in self._history:
+                    continue
+                self._entries[key] = size
+                self._entries.move_to_end(key, last=False)
+                self._bytes += size
+        self._schedule_prune()
+
+    @staticmethod
+    def key(voice: str, text: str) -> str:
+        return hashlib.sha256(f"{voice}\0{text}".encode("utf-8")).hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def _lookup(self, key: str) -> bool:
+        with self._lock:
+            for entries in (self._entries, self._history):
+                if key in entries:
+                    entries.move_to_end(key)
+                    return True
+            return False
+
+    def _add(self, key: str, size: int):
+        with self._lock:
+            entries = self._history if key in self._history else self._entries
+            self._bytes += size - entries.pop(key, 0)
+            entries[key] = size
+        self._schedule_prune()
+
+    def _remove_files(self, keys):
+        """Delete the files of `keys` unless they were cached again meanwhile."""
+        with self._lock:
+            for key in keys:
+                if key in self._entries or key in self._history:
+                    continue
+                try:
+                    os.remove(self.path_for(key))
+                except FileNotFoundError:
+                    pass
+
+    def _schedule_prune(self):
+        with self._lock:
+            if self._pruning or self._bytes <= self.max_bytes:
+                return
+            self._pruning = True
+        submit_db(self.prune)
+
+    def prune(self):
+        """
+        Delete files until the cache fits its size, the ones the history does
+        not point to first. Runs on the database thread pool, as it looks the
+        files up in the messages table.
+        """
+        try:
+            while True:
+                with self._lock:
+                    if self._bytes <= self.max_bytes:
+                        return
+                    candidates = list(itertools.islice(self._entries, PRUNE_BATCH))
+                if candidates:
+                    self._prune_unreferenced(candidates)
+                else:
+                    self._prune_history()
+        finally:
+            with self._lock:
+                self._pruning = False
+            self._schedule_prune()
+
+    def _prune_unreferenced(self, candidates):
+        referenced = chat_storage_manager.referenced_audio_urls(
+            [audio_url_for(self.path_for(key)) for key in candidates]
+        )
+        removed = []
+        with self._lock:
+            for key in candidates:
+                if self._bytes <= self.max_bytes:
+                    break
+                # Skip files used again since the candidates were taken.
+                if next(iter(self._entries), None) != key:
+                    continue
+                size = self._entries.pop(key)
+                if audio_url_for(self.path_for(key)) in referenced:
+                    self._history[key] = size
+                else:
+                    self._bytes -= size
+                    removed.append(key)
+        self._remove_files(removed)
+
+    def _prune_history(self):
+        removed = []
+        with self._lock:
+            while (
+                self._history
+                and self._bytes > self.max_bytes
+                and len(removed) < PRUNE_BATCH
+            ):
+                key, size = self._history.popitem(last=False)
+                self._bytes -= size
+                removed.append(key)
+        if not removed:
+            return
+        chat_storage_manager.clear_audio_urls(
+            [audio_url_for(self.path_for(key)) for key in removed]
+        )
+        self._remove_files(removed)
+        logging.info(
+            "Dropped the audio of %d old answers from the TTS cache", len(removed)
+        )
+
+    async def get_or_synthesize(self, voice: str, text: str, synthesize) -> str:
+        """
+        Return the path of the audio for `text`, calling
+        `synthesize(text, voice, path)` only when it is not cached yet.
+        Concurrent requests for the same audio share one synthesis.
+        """
+        key = self.key(voice, text)
+        path = self.path_for(key)
+        if self._lookup(key) and os.path.exists(path):
+            self.hits += 1
+            return path
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            await asyncio.wait({pending})
+            if not pending.cancelled():
+                self.hits += 1
+                return path
+            # The other synthesis failed or was abandoned; try it ourselves.
+
+        self.misses += 1
+        pending = asyncio.get_running_loop().create_future()
+        self._pending[key] = pending
+        # Write next to the final name so a half-written file is never served.
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            await synthesize(text, voice, partial_path)
+            os.replace(partial_path, path)
+            self._add(key, os.path.getsize(path))
+            pending.set_result(None)
+        except BaseException:
+            pending.cancel()
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        finally:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+        return path
+
+    def combine(self, paths: list[str]) -> str:
+        """The cached audio of the files at `paths` joined into one."""
+        key = self.key("combined", "\0".join(os.path.basename(p) for p in paths))
+        path = self.path_for(key)
+        if self._lookup(key) and os.path.exists(path):
+            return path
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            _join_audio(paths, partial_path)
+            os.replace(partial_path, path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        self._add(key, os.path.getsize(path))
+        return path
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "history_entries": len(self._history),
+            }
+
+
+tts_cache = None
+if tts_cache_max_mb > 0:
+    tts_cache = TTSCache(tts_cache_dir, tts_cache_max_mb * 1024 * 1024)
+
+
 async def save_speak_file(text: str, lang: str = "en", request_id: str = None):
     """
-    Save the spoken text to an audio file using edge_tts.
-    The audio file is saved in the static/audio directory.
+    Save the spoken text to an audio file using the configured TTS backend
+    and return its path. With the TTS cache enabled the file is shared by all
+    answers with the same voice and text, otherwise it is
+    static/audio/audio-<request_id>.mp3.
     """
-    voice_map = {
-        "en": "en-US-AriaNeural",
-        "fr": "fr-FR-DeniseNeural",
-        "de": "de-DE-KatjaNeural",
-        "es": "es-ES-ElviraNeural",
-        "it": "it-IT-ElsaNeural",
-        "pt": "pt-PT-FernandaNeural",
-        "ru": "ru-RU-DariyaNeural",
-        "zh": "zh-CN-XiaoxiaoNeural",
-        "ja": "ja-JP-NanamiNeural",
-        "ko": "ko-KR-SunHiNeural",
-        "tr": "tr-TR-EmelNeural",
-    }
-
-    voice = voice_map.get(lang, "en-US-AriaNeural")
-    output_file_path = os.path.join("static", "audio", f"audio-{request_id}.mp3")
+    voice = voice_for_language(lang)
     cleaned_text = clean_text_for_tts(text)
+    synthesize = TTS_BACKENDS[tts_backend]
 
     try:
-        communicate = edge_tts.Communicate(cleaned_text, voice)
-        await communicate.save(output_file_path)
+        if tts_cache is not None:
+            output_file_path = await tts_cache.get_or_synthesize(
+                voice, cleaned_text, synthesize
+            )
+        else:
+            output_file_path = os.path.join(
+                "static", "audio", f"audio-{request_id}.mp3"
+            )
+            await synthesize(cleaned_text, voice, output_file_path)
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Failed to generate speech: {str(e)}"
@@ -49,114 +330,315 @@ async def save_speak_file(text: str, lang: str = "en", request_id: str = None):
     return output_file_path
 
 
-def validate_and_convert_audio(input_file):
-    try:
-        repaired_file = f"{input_file}_repaired.webm"
-        temp_wav = f"{input_file}.wav"
+def audio_url_for(path: str) -> str:
+    """The URL under which the static mount serves an audio file."""
+    return "/" + path.replace(os.sep, "/")
 
-        try:
-            repair_cmd = ["ffmpeg", "-i", input_file, "-c", "copy", "-y", repaired_file]
-            subprocess.run(
-                repair_cmd, check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
 
-            if os.path.exists(repaired_file) and os.path.getsize(repaired_file) > 0:
-                input_file = repaired_file
-                logging.info(f"Successfully repaired WebM file: {repaired_file}")
-        except Exception as e:
-            logging.warning(f"WebM repair attempt failed: {str(e)}")
-
-        cmd = [
-            "ffprobe",
-            "-v",
-            "error",
-            "-show_entries",
-            "stream=index,codec_name,codec_type",
-            "-of",
-            "json",
-            input_file,
-        ]
-        result = subprocess.run(
-            cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        logging.info(f"FFprobe output: {result.stdout.decode()}")
-
-        cmd = [
-            "ffmpeg",
-            "-i",
-            input_file,
-            "-ar",
-            "16000",
-            "-ac",
-            "1",
-            "-c:a",
-            "pcm_s16le",
-            "-f",
-            "wav",
-            "-y",
-            temp_wav,
-        ]
-        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        logging.info(f"File converted to WAV: {temp_wav}")
+class SentenceSegmenter:
+    """
+    Cuts a stream of text chunks into sentences. Short sentences are merged
+    until a segment has at least `min_chars` characters, so the TTS backend is
+    not called for every "Sure." on its own.
+    """
+
+    def __init__(self, min_chars: int):
+        self.min_chars = min_chars
+        self._buffer = ""
 
-        if os.path.exists(repaired_file):
-            try:
-                os.remove(repaired_file)
-            except Exception:
-                pass
+    def feed(self, text: str) -> list[str]:
+        self._buffer += text
+        segments = []
+        start = 0
+        for match in SENTENCE_END.finditer(self._buffer):
+            if match.end() - start >= self.min_chars:
+                segments.append(self._buffer[start : match.start()].strip())
+                start = match.end()
+        self._buffer = self._buffer[start:]
+        return [segment for segment in segments if segment]
 
-        return temp_wav
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error during validation/conversion: {e.stderr.decode()}")
+    def flush(self) -> list[str]:
+        segment, self._buffer = self._buffer.strip(), ""
+        return [segment] if segment else []
 
+
+class IncrementalSpeech:
+    """
+    Synthesizes an answer sentence by sentence while the LLM is still
+    generating it. Segments are synthesized concurrently and handed out in
+    order as soon as each one, and all before it, are ready.
+    """
+
+    def __init__(
+        self, request_id: str, detect_language, min_chars: int, on_synthesized=None
+    ):
+        self.request_id = request_id
+        self.lang = None
+        self._detect_language = detect_language
+        # Called with the seconds each segment took to synthesize.
+        self._on_synthesized = on_synthesized
+        self._segmenter = SentenceSegmenter(min_chars)
+        self._tasks: list[asyncio.Task] = []
+        self._emitted = 0
+
+    def _start(self, segment: str):
+        if self.lang is None:
+            self.lang = self._detect_language(segment)
+        index = len(self._tasks)
+        self._tasks.append(asyncio.create_task(self._synthesize(segment, index)))
+
+    async def _synthesize(self, segment: str, index: int) -> str:
+        started = time.perf_counter()
         try:
-            logging.info("Trying fallback conversion method...")
-            fallback_cmd = [
-                "ffmpeg",
-                "-i",
-                input_file,
-                "-ar",
-                "16000",
-                "-ac",
-                "1",
-                "-acodec",
-                "pcm_s16le",
-                "-y",
-                "-f",
-                "wav",
-                "-fflags",
-                "+genpts",
-                "-ignore_unknown",
-                temp_wav,
-            ]
-            subprocess.run(
-                fallback_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            logging.info(f"Fallback conversion succeeded: {temp_wav}")
-            return temp_wav
-        except subprocess.CalledProcessError as inner_e:
-            logging.error(
-                f"Fallback conversion also failed: {inner_e.stderr.decode() if hasattr(inner_e, 'stderr') else str(inner_e)}"
+            return await save_speak_file(
+                segment, self.lang, f"{self.request_id}-{index}"
             )
+        finally:
+            if self._on_synthesized is not None:
+                self._on_synthesized(time.perf_counter() - started)
+
+    def feed(self, text: str):
+        for segment in self._segmenter.feed(text):
+            self._start(segment)
+
+    def finish(self):
+        """Synthesize whatever is left after the last sentence end."""
+        for segment in self._segmenter.flush():
+            self._start(segment)
+
+    @staticmethod
+    def _succeeded(task: asyncio.Task) -> bool:
+        if task.cancelled():
             return False
-    except Exception as e:
-        logging.error(f"Unexpected error in audio validation: {str(e)}")
-        return False
+        if task.exception() is not None:
+            logging.error("Audio segment failed: %s", task.exception())
+            return False
+        return True
+
+    def pop_ready(self) -> list[str]:
+        """Audio URLs of the segments that finished since the last call."""
+        urls = []
+        while self._emitted < len(self._tasks) and self._tasks[self._emitted].done():
+            task = self._tasks[self._emitted]
+            self._emitted += 1
+            if self._succeeded(task):
+                urls.append(audio_url_for(task.result()))
+        return urls
+
+    async def remaining(self):
+        """Wait for the outstanding segments and yield their URLs in order."""
+        while self._emitted < len(self._tasks):
+            await asyncio.wait({self._tasks[self._emitted]})
+            for url in self.pop_ready():
+                yield url
+
+    def combine(self) -> str | None:
+        """Join the segments into one file for replaying the whole answer."""
+        paths = [
+            task.result()
+            for task in self._tasks
+            if task.done() and not task.cancelled() and task.exception() is None
+        ]
+        if not paths:
+            return None
+        if tts_cache is not None:
+            return tts_cache.combine(paths)
+        output_file_path = os.path.join(
+            "static", "audio", f"audio-{self.request_id}.mp3"
+        )
+        _join_audio(paths, output_file_path)
+        return output_file_path
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+
+FFMPEG_TO_PCM = [
+    "ffmpeg",
+    "-hide_banner",
+    "-loglevel",
+    "error",
+    "-fflags",
+    "+genpts",
+    "-i",
+    "pipe:0",
+    "-vn",
+    "-ar",
+    str(PCM_SAMPLE_RATE),
+    "-ac",
+    "1",
+    "-acodec",
+    "pcm_s16le",
+    "-f",
+    "s16le",
+    "pipe:1",
+]
+
+
+def _needs_seeking(file_content: bytes) -> bool:
+    """
+    Whether the recording is an MP4/M4A file, as Safari records. Unless they
+    are fragmented, these keep their index (the moov atom) at the end, which
+    ffmpeg cannot reach when reading from a pipe.
+    """
+    return file_content[4:8] == b"ftyp"
+
+
+def _write_temp_file(file_content: bytes) -> str:
+    fd, path = tempfile.mkstemp(prefix="upload-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(file_content)
+    return path
 
 
-def recognize_from_audio(input_file, language="tr"):
+async def transcode_to_pcm(file_content: bytes) -> bytes:
+    """
+    Decode an uploaded recording with a single ffmpeg process, feeding it on
+    stdin and reading raw PCM from stdout, so nothing touches the disk.
+    Reading from a pipe also copes with the missing duration and cues of
+    MediaRecorder WebM files. MP4 files are decoded from a temporary file
+    instead, as ffmpeg has to seek in them.
+    """
+    if not _needs_seeking(file_content):
+        return await _run_ffmpeg_to_pcm(FFMPEG_TO_PCM, file_content)
+
+    loop = asyncio.get_running_loop()
+    path = await loop.run_in_executor(None, _write_temp_file, file_content)
     try:
-        if not input_file or not os.path.exists(input_file):
-            raise Exception(f"Audio file not found: {input_file}")
+        command = [path if arg == "pipe:0" else arg for arg in FFMPEG_TO_PCM]
+        return await _run_ffmpeg_to_pcm(command, b"")
+    finally:
+        os.remove(path)
+
+
+async def _run_ffmpeg_to_pcm(command: list[str], file_content: bytes) -> bytes:
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        pcm, errors = await process.communicate(file_content)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if process.returncode != 0 or not pcm:
+        logging.error(
+            "ffmpeg could not decode the audio (exit %s): %s",
+            process.returncode,
+            errors.decode(errors="replace").strip(),
+        )
+        raise HTTPException(status_code=400, detail="Invalid or corrupted audio file")
+
+    logging.info(f"Decoded {len(pcm)} bytes of PCM audio")
+    return pcm
+
+
+# Decodes a recording that is still being uploaded; small probe sizes let
+# ffmpeg start writing PCM after the first chunks instead of buffering.
+FFMPEG_STREAM_TO_PCM = [
+    FFMPEG_TO_PCM[0],
+    "-probesize",
+    "32768",
+    "-analyzeduration",
+    "0",
+    "-flags",
+    "low_delay",
+    *FFMPEG_TO_PCM[1:],
+]
+
+
+class StreamingTranscoder:
+    """An ffmpeg process that turns recording chunks into PCM as they arrive."""
+
+    def __init__(self):
+        self._process = None
+
+    async def start(self):
+        self._process = await asyncio.create_subprocess_exec(
+            *FFMPEG_STREAM_TO_PCM,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+
+    async def write(self, data: bytes):
+        self._process.stdin.write(data)
+        await self._process.stdin.drain()
+
+    def close_input(self):
+        if not self._process.stdin.is_closing():
+            self._process.stdin.close()
+
+    async def read(self, size: int) -> bytes:
+        """Read `size` bytes of PCM, or less once the input is over."""
+        try:
+            return await self._process.stdout.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    async def aclose(self):
+        if self._process is not None and self._process.returncode is None:
+            self._process.kill()
+            await self._process.wait()
+
+
+class EndOfSpeechDetector:
+    """
+    Energy based voice activity detection on 16 kHz PCM. Reports the end of
+    an utterance once speech was heard and then `silence_ms` of frames stayed
+    below `threshold` RMS, or when the utterance reaches `max_ms`.
+    """
+
+    FRAME_MS = 30
+
+    def __init__(self, threshold: int, silence_ms: int, max_ms: int):
+        self.threshold = threshold
+        self.frame_bytes = PCM_SAMPLE_RATE * self.FRAME_MS // 1000 * 2
+        self.silence_frames = silence_ms // self.FRAME_MS
+        self.max_frames = max_ms // self.FRAME_MS
+        self.heard_speech = False
+        self._frames = 0
+        self._silent_run = 0
+        self._pending = b""
+
+    def _is_speech(self, frame: bytes) -> bool:
+        samples = array.array("h", frame)
+        rms = math.sqrt(sum(sample * sample for sample in samples) / len(samples))
+        return rms >= self.threshold
+
+    def feed(self, pcm: bytes) -> bool:
+        """Add PCM and return True once the utterance is over."""
+        data = self._pending + pcm
+        usable = len(data) - len(data) % self.frame_bytes
+        self._pending = data[usable:]
+        for offset in range(0, usable, self.frame_bytes):
+            self._frames += 1
+            if self._is_speech(data[offset : offset + self.frame_bytes]):
+                self.heard_speech = True
+                self._silent_run = 0
+            else:
+                self._silent_run += 1
+            if self._frames >= self.max_frames or (
+                self.heard_speech and self._silent_run >= self.silence_frames
+            ):
+                return True
+        return False
 
-        logging.info(f"Performing speech recognition on {input_file}...")
-        recognizer = sr.Recognizer()
 
-        with sr.AudioFile(input_file) as source:
-            audio = recognizer.record(source)
-            user_input = recognizer.recognize_google(audio, language=language)
+def recognize_from_audio(pcm: bytes, language="tr"):
+    try:
+        logging.info("Performing speech recognition...")
+        user_input = recognize(pcm, language)
+        if not user_input:
+            raise Exception("")
 
-        logging.info(f"Recognition successful: '{user_input}'")
+        logging.info("Recognition successful: %s", preview(user_input))
         return user_input
     except Exception as ex:
         e = str(ex)
@@ -167,11 +649,7 @@ def recognize_from_audio(input_file, language="tr"):
 
 
 async def process_audio_file_common(file, is_async=False):
-    temp_files = []
-    wav_file = None
-
     try:
-        unique_id = str(uuid.uuid4())
         if is_async:
             file_content = await file.read()
         else:
@@ -182,31 +660,13 @@ async def process_audio_file_common(file, is_async=False):
 
         logging.info(f"Received file: {file.filename}, size: {len(file_content)} bytes")
 
-        raw_file = f"temp_raw{unique_id}.webm"
-        temp_files.append(raw_file)
-
-        with open(raw_file, "wb") as f:
-            f.write(file_content)
-
-        wav_file = validate_and_convert_audio(raw_file)
-
-        if not wav_file:
-            raise HTTPException(
-                status_code=400, detail="Invalid or corrupted audio file"
-            )
-
-        temp_files.append(wav_file)
-
-        return recognize_from_audio(wav_file, language="tr")
+        pcm = await transcode_to_pcm(file_content)
+        return await stt_pool.run(recognize_from_audio, pcm, "tr")
     except Exception as e:
+        if isinstance(e, HTTPException) and e.status_code in (503, 504):
+            # A busy or slow recognizer is not the client's fault.
+            raise
         logging.error(f"Audio processing error: {str(e)}")
         raise HTTPException(
             status_code=400, detail=f"Audio processing failed: {str(e)}"
         ) from e
-    finally:
-        for path in temp_files:
-            if path and os.path.exists(path):
-                try:
-                    logging.debug(f"Removed temporary file: {path}")
-                except Exception as e:
-                    logging.warning(f"Failed to remove temporary file {path}: {str(e)}")
@@ -22,6 +22,9 @@ const emptyChatText = $('empty-chat-text');
 let mediaRecorder,
 	audioChunks = [],
 	currentAudio = null;
+let audioSegments = [],
+	isSegmentPlaying = false,
+	isSegmentPlaybackStopped = false;
 let isPlaying = false,
 	isRecording = false;
 let stream = null,
@@ -35,6 +38,12 @@ let tooltip = null;
 let isHoverTooltip = false;
 let currentTarget = null;
 let pendingChannelId; // This will be used to store the channelId from the URL, when channel could not be found on list. on populating list, will be selected.
+// Version of the channel list, sent back to /api/data to get only changes.
+let channelsVersion = null;
+// Sequence number of the oldest message shown and whether there are older ones.
+let oldestHistorySequence = null,
+	hasOlderHistory = false,
+	isLoadingOlderHistory = false;
 
 const isMobile = /Mobi|Android|iPhone|iPad|iPod/i.test(navigator.userAgent);
 const SenderType = {
@@ -42,6 +51,9 @@ const SenderType = {
 	USER: 'USER',
 };
 const placeholder = textInput.getAttribute('placeholder');
+const HISTORY_PAGE_SIZE = 50;
+// Older messages are loaded when scrolled this close to the top.
+const HISTORY_LOAD_THRESHOLD_PX = 200;
 
 // --- Event Listeners ---
 
@@ -198,12 +210,23 @@ async function processChatRequest(formData) {
 		if (selectedModel) {
 			formData.append('model', selectedModel);
 		}
+		formData.append('stream_format', 'ndjson');
 
 		const response = await fetch('/api/chat', {
 			method: 'POST',
 			body: formData,
 		});
 		if (!response.ok) {
+			if (response.status === 429 || response.status === 503) {
+				const retryAfter = response.headers.get('Retry-After');
+				appendMessage(
+					SenderType.AI,
+					`The server is busy, please try again in ${retryAfter || 'a few'} seconds.`,
+					false,
+					true
+				);
+				return;
+			}
 			if (response.status === 404) {
 				appendMessage(
 					SenderType.AI,
@@ -224,59 +247,104 @@ async function processChatRequest(formData) {
 
 		const reader = response.body.getReader();
 		const decoder = new TextDecoder('utf-8');
-		let accumulatedText = '';
-		let audioUrl = null;
-		let messageStarted = false;
-
-		const buffer = createBuffer(text => {
-			if (usedChannel === currentChannelId) {
-				if (!messageStarted) {
-					appendMessage(SenderType.AI, text, true);
-					messageStarted = true;
-				} else {
-					appendMessage(SenderType.AI, text, true);
-				}
-			}
-			accumulatedText += text;
-		});
-
-		statusDiv.textContent = 'Receiving response...';
+		const renderer = createResponseRenderer(usedChannel);
+		// The body is one JSON event per line; a read may end mid-line.
+		let pendingLine = '';
 
 		while (true) {
 			const { done, value } = await reader.read();
 			if (done) break;
 
-			const chunk = decoder.decode(value, { stream: true });
-			const { text, foundAudioUrl, foundResolvedText } =
-				processChunk(chunk);
-
-			if (foundResolvedText) {
-				buffer.flushNow();
-				appendMessage(SenderType.USER, foundResolvedText, false);
-				continue;
+			pendingLine += decoder.decode(value, { stream: true });
+			const lines = pendingLine.split('\n');
+			pendingLine = lines.pop();
+			for (const line of lines) {
+				if (line.trim() !== '') await renderer.onEvent(JSON.parse(line));
 			}
+		}
 
-			if (text !== undefined && text !== null) {
-				buffer.append(text);
-			}
+		await renderer.finish();
+	} catch (error) {
+		statusDiv.textContent = '';
+		console.error('Error processing chat request:', error);
+	}
+}
+
+// Renders the events of a chat response, whether they come from the
+// /api/chat stream or from the voice WebSocket.
+function createResponseRenderer(usedChannel) {
+	let accumulatedText = '';
+	let audioUrl = null;
+	let receivedAudioSegments = false;
+	let finished = false;
+	isSegmentPlaybackStopped = false;
+
+	const buffer = createBuffer(text => {
+		if (usedChannel === currentChannelId) {
+			appendMessage(SenderType.AI, text, true);
+		}
+		accumulatedText += text;
+	});
 
-			if (foundAudioUrl) {
-				audioUrl = foundAudioUrl;
+	statusDiv.textContent = 'Receiving response...';
+
+	const onMeta = event => {
+		if (event.queue_position) {
+			statusDiv.textContent = `Waiting in queue (position ${event.queue_position})...`;
+		}
+		if (event.channel_id && event.channel_name) {
+			if (!usedChannel && !currentChannelId) {
+				usedChannel = event.channel_id;
+				pushState(event.channel_id);
 			}
+			upsertChannel(event.channel_id, event.channel_name);
+		}
+		if (event.resolved_text) {
+			buffer.flushNow();
+			appendMessage(SenderType.USER, event.resolved_text, false);
 		}
+	};
 
+	const onEvent = async event => {
+		switch (event.type) {
+			case 'meta':
+				onMeta(event);
+				break;
+			case 'token':
+				statusDiv.textContent = 'Receiving response...';
+				buffer.append(event.text);
+				break;
+			case 'audio':
+				if (event.final) {
+					audioUrl = event.audio_url;
+				} else if (usedChannel === currentChannelId) {
+					receivedAudioSegments = true;
+					queueResponseAudio(event.audio_url);
+				}
+				break;
+			case 'error':
+				buffer.append(event.detail);
+				break;
+			case 'done':
+				await finish();
+				break;
+		}
+	};
+
+	const finish = async () => {
+		if (finished) return;
+		finished = true;
 		buffer.flushNow();
 		statusDiv.textContent = '';
 		if (usedChannel === currentChannelId) {
-			if (audioUrl) {
+			if (audioUrl && !receivedAudioSegments) {
 				await playResponseAudio(audioUrl);
 			}
 			finalizeStreamingBubble(accumulatedText, audioUrl);
 		}
-	} catch (error) {
-		statusDiv.textContent = '';
-		console.error('Error processing chat request:', error);
-	}
+	};
+
+	return { onEvent, finish };
 }
 
 function createBuffer(onFlush, smoothness = 50) {
@@ -313,73 +381,6 @@ function createBuffer(onFlush, smoothness = 50) {
 	return { append, flushNow };
 }
 
-function processChunk(chunk) {
-	const JSON_START = '$[[START_JSON]]';
-	const JSON_END = '$[[END_JSON]]';
-	const AUDIO_START = '$[[AUDIO_DONE]]';
-	const AUDIO_END = '$[[AUDIO_DONE]]';
-
-	let foundAudioUrl = null;
-	let foundResolvedText = null;
-	let remainingText = chunk;
-
-	const jsonStartIndex = chunk.indexOf(JSON_START);
-	const jsonEndIndex = chunk.indexOf(JSON_END);
-
-	if (
-		jsonStartIndex !== -1 &&
-		jsonEndIndex !== -1 &&
-		jsonEndIndex > jsonStartIndex
-	) {
-		const jsonChunk = chunk.substring(
-			jsonStartIndex + JSON_START.length,
-			jsonEndIndex
-		);
-		try {
-			const parsedJson = JSON.parse(jsonChunk);
-			if (parsedJson.resolved_text)
-				foundResolvedText = parsedJson.resolved_text;
-		} catch {}
-		remainingText =
-			chunk.slice(0, jsonStartIndex) +
-			chunk.slice(jsonEndIndex + JSON_END.length);
-	}
-
-	const audioStartIndex = remainingText.indexOf(AUDIO_START);
-	const audioEndIndex = remainingText.indexOf(
-		AUDIO_END,
-		audioStartIndex + AUDIO_START.length
-	);
-
-	if (
-		audioStartIndex !== -1 &&
-		audioEndIndex !== -1 &&
-		audioEndIndex > audioStartIndex
-	) {
-		const audioChunk = remainingText.substring(
-			audioStartIndex + AUDIO_START.length,
-			audioEndIndex
-		);
-		try {
-			const parsedAudio = JSON.parse(audioChunk);
-			if (parsedAudio.audio_url) foundAudioUrl = parsedAudio.audio_url;
-			if (parsedAudio.channel_id) {
-				addChannel(parsedAudio.channel_id);
-				pushState(channelId);
-			}
-		} catch {}
-		remainingText =
-			remainingText.slice(0, audioStartIndex) +
-			remainingText.slice(audioEndIndex + AUDIO_END.length);
-	}
-
-	return {
-		text: remainingText,
-		foundAudioUrl,
-		foundResolvedText,
-	};
-}
-
 function pushState(channelId) {
 	if (channelId && channelId !== currentChannelId) {
 		currentChannelId = channelId;
@@ -396,21 +397,38 @@ function finalizeStreamingBubble(accumulatedText, audioUrl) {
 		addToolbarOnMessage(streamBubble, accumulatedText, audioUrl);
 	}
 }
+function historySender(msg) {
+	return msg.role.toUpperCase() === SenderType.USER
+		? SenderType.USER
+		: SenderType.AI;
+}
+
 async function fetchAndRenderHistory(channelId) {
 	try {
 		currentChannelId = channelId;
 		pushState(channelId);
-		const data = await requestJSON(`/api/history/${channelId}`);
+		oldestHistorySequence = null;
+		hasOlderHistory = false;
+		const data = await requestJSON(
+			`/api/history/${channelId}?limit=${HISTORY_PAGE_SIZE}`
+		);
+		if (currentChannelId !== channelId) return;
 		$empty(chatContainer);
 
 		if (Array.isArray(data.history)) {
 			data.history.forEach(msg => {
-				const sender =
-					msg.role.toUpperCase() === SenderType.USER
-						? SenderType.USER
-						: SenderType.AI;
-				appendMessage(sender, msg.content, false, false, msg.audio_url);
+				appendMessage(
+					historySender(msg),
+					msg.content,
+					false,
+					false,
+					msg.audio_url
+				);
 			});
+			if (data.history.length > 0) {
+				oldestHistorySequence = data.history[0].sequence;
+				hasOlderHistory = data.has_more;
+			}
 		} else {
 			appendMessage(SenderType.AI, '');
 		}
@@ -422,9 +440,52 @@ async function fetchAndRenderHistory(channelId) {
 	} catch {}
 }
 
+// Loads the page of messages before the oldest one shown and puts it above
+// them, keeping the messages in view where they are.
+async function loadOlderHistory() {
+	if (isLoadingOlderHistory || !hasOlderHistory || !currentChannelId) return;
+	const channelId = currentChannelId;
+	isLoadingOlderHistory = true;
+	try {
+		const data = await requestJSON(
+			`/api/history/${channelId}?limit=${HISTORY_PAGE_SIZE}&before=${oldestHistorySequence}`
+		);
+		if (currentChannelId !== channelId || data.history.length === 0) return;
+
+		const fragment = document.createDocumentFragment();
+		const bubbles = data.history.map(msg =>
+			createMessageBubble(
+				historySender(msg),
+				msg.content,
+				false,
+				msg.audio_url
+			)
+		);
+		bubbles.forEach(bubble => fragment.appendChild(bubble));
+		const previousHeight = chatContainer.scrollHeight;
+		chatContainer.insertBefore(fragment, chatContainer.firstChild);
+		chatContainer.scrollTop += chatContainer.scrollHeight - previousHeight;
+		if (window.MathJax) MathJax.typesetPromise(bubbles);
+
+		oldestHistorySequence = data.history[0].sequence;
+		hasOlderHistory = data.has_more;
+	} catch (e) {
+		console.error('Failed to load older messages:', e);
+	} finally {
+		isLoadingOlderHistory = false;
+	}
+}
+
+chatContainer.addEventListener('scroll', () => {
+	if (chatContainer.scrollTop < HISTORY_LOAD_THRESHOLD_PX) {
+		loadOlderHistory();
+	}
+});
+
 async function fetchChannelsAndModels() {
 	try {
 		const data = await requestJSON('/api/data');
+		channelsVersion = data.version;
 
 		if (Array.isArray(data.channels)) {
 			$empty(channelList);
@@ -467,6 +528,37 @@ async function fetchChannelsAndModels() {
 	}
 }
 
+// Applies the changes made to the channels, e.g. in another tab, since they
+// were loaded. An unchanged list costs a 304 without a database query.
+async function refreshChannels() {
+	if (channelsVersion === null) return;
+	try {
+		const data = await requestJSON(
+			`/api/data?since_version=${channelsVersion}`
+		);
+		if (Array.isArray(data.channels)) {
+			populateChannels(data.channels);
+			channelList
+				.querySelector(`.channel-button[id="${currentChannelId}"]`)
+				?.parentNode.classList.add('selected-channel');
+		} else {
+			data.deleted.forEach(removeChannel);
+			data.changed
+				.reverse()
+				.forEach(channel => upsertChannel(channel.id, channel.name));
+		}
+		channelsVersion = data.version;
+	} catch (e) {
+		console.error('Failed to refresh channels:', e);
+	}
+}
+
+document.addEventListener('visibilitychange', () => {
+	if (document.visibilityState === 'visible') {
+		refreshChannels();
+	}
+});
+
 function selectModel(name) {
 	modelsButton.textContent = name;
 	dropdown.classList.toggle('hidden');
@@ -533,16 +625,7 @@ async function deleteChannelHistory(channelId) {
 			method: 'DELETE',
 		});
 		if (!response.ok) throw new Error('Failed to delete history');
-		const channel = channelList.querySelector(`li[id="${channelId}"]`);
-		if (channel) {
-			channel.remove();
-		}
-
-		if (currentChannelId && channelId === currentChannelId) {
-			$empty(chatContainer);
-			currentChannelId = '';
-			stopAudio();
-		}
+		removeChannel(channelId);
 	} catch (error) {
 		console.error('Error deleting history:', error);
 		alert(
@@ -551,6 +634,19 @@ async function deleteChannelHistory(channelId) {
 	}
 }
 
+function removeChannel(channelId) {
+	const channel = channelList.querySelector(`li[id="${channelId}"]`);
+	if (channel) {
+		channel.remove();
+	}
+
+	if (currentChannelId && channelId === currentChannelId) {
+		$empty(chatContainer);
+		currentChannelId = '';
+		stopAudio();
+	}
+}
+
 async function deleteAllHistory() {
 	try {
 		const response = await fetch('/api/history/delete-all', {
@@ -570,6 +666,19 @@ async function deleteAllHistory() {
 	}
 }
 
+// Adds a channel to the sidebar, or renames it when it is already listed.
+function upsertChannel(channelId, channelName) {
+	const button = channelList.querySelector(
+		`.channel-button[id="${CSS.escape(channelId)}"]`
+	);
+	if (!button) {
+		$('noHistoryButton')?.parentNode.remove();
+		addChannel(channelId, channelName || channelId);
+	} else if (channelName) {
+		button.textContent = channelName;
+	}
+}
+
 function addChannel(channelId, channelName) {
 	const li = $ce('li');
 	li.className = 'mb-3 channel-item';
@@ -735,24 +844,29 @@ function appendMessage(
 
 		streamingText = '';
 	} else {
-		bubble = $ce('div');
-		bubble.className = `p-3 rounded ${sender === SenderType.USER ? 'self-end ml-auto' : 'self-start mr-auto'} max-w-fit break-words message-animate`;
-		bubble.style.backgroundColor =
-			sender === SenderType.USER ? '#303030' : 'transparent';
-		bubble.style.marginBottom = '0.5rem';
-
-		const md = window.markdownit();
-		bubble.innerHTML = md.render(text);
-		if (isRed) bubble.style.color = 'red';
-
+		bubble = createMessageBubble(sender, text, isRed, audioUrl);
 		chatContainer.appendChild(bubble);
-		addToolbarOnMessage(bubble, text, audioUrl);
 	}
 
 	chatContainer.scrollTop = chatContainer.scrollHeight;
 	if (window.MathJax) MathJax.typesetPromise([bubble]);
 }
 
+function createMessageBubble(sender, text, isRed = false, audioUrl = '') {
+	const bubble = $ce('div');
+	bubble.className = `p-3 rounded ${sender === SenderType.USER ? 'self-end ml-auto' : 'self-start mr-auto'} max-w-fit break-words message-animate`;
+	bubble.style.backgroundColor =
+		sender === SenderType.USER ? '#303030' : 'transparent';
+	bubble.style.marginBottom = '0.5rem';
+
+	const md = window.markdownit();
+	bubble.innerHTML = md.render(text);
+	if (isRed) bubble.style.color = 'red';
+
+	addToolbarOnMessage(bubble, text, audioUrl);
+	return bubble;
+}
+
 channelList.addEventListener('click', event => {
 	if (event.target.classList.contains('channel-dropdown-button')) {
 		const dropdownMenu = event.target.nextElementSibling;
@@ -808,6 +922,29 @@ async function playResponseAudio(url) {
 	await currentAudio.play();
 }
 
+// Plays the sentence-level audio segments of an answer one after another.
+function queueResponseAudio(url) {
+	if (isSegmentPlaybackStopped) return;
+	audioSegments.push(url);
+	if (!isSegmentPlaying) playNextAudioSegment();
+}
+
+function playNextAudioSegment() {
+	const url = audioSegments.shift();
+	if (!url) {
+		isSegmentPlaying = false;
+		isPlaying = false;
+		toggleSendButton(false);
+		return;
+	}
+	isSegmentPlaying = true;
+	currentAudio = new Audio(url);
+	currentAudio.onended = playNextAudioSegment;
+	isPlaying = true;
+	toggleSendButton(true);
+	currentAudio.play().catch(playNextAudioSegment);
+}
+
 function showDeleteModal() {
 	const modal = $ce('div');
 	modal.className =
@@ -930,14 +1067,30 @@ async function startRecording() {
 		mediaRecorder = new MediaRecorder(stream, options);
 		audioChunks = [];
 
+		// WebM can be decoded while it is still being recorded, so it is
+		// streamed to the server, which answers as soon as speech ends.
+		const socket =
+			supportedMimeType.includes('webm') && window.WebSocket
+				? openVoiceSocket()
+				: null;
+
 		mediaRecorder.ondataavailable = e => {
-			if (e.data.size) audioChunks.push(e.data);
+			if (!e.data.size) return;
+			if (socket) {
+				socket.sendAudio(e.data);
+			} else {
+				audioChunks.push(e.data);
+			}
 		};
 
 		const minimumRecordingTimeMs = 1000;
 		let recordingStartTime = Date.now();
 
 		mediaRecorder.onstop = async () => {
+			if (socket) {
+				socket.stop();
+				return;
+			}
 			if (audioChunks.length === 0) return;
 
 			const recordingDuration = Date.now() - recordingStartTime;
@@ -986,8 +1139,98 @@ async function startRecording() {
 	}
 }
 
+function openVoiceSocket() {
+	const params = new URLSearchParams();
+	if (currentChannelId) params.append('channel_id', currentChannelId);
+	const selectedModel = getSelectedModel();
+	if (selectedModel) params.append('model', selectedModel);
+	const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+	const socket = new WebSocket(
+		`${protocol}//${location.host}/ws/voice?${params}`
+	);
+
+	const usedChannel = currentChannelId;
+	// Chunks recorded before the connection opens, including the WebM header.
+	const pending = [];
+	let renderer = null;
+	let answered = false;
+	let failed = false;
+
+	socket.onopen = () => {
+		pending.splice(0).forEach(chunk => socket.send(chunk));
+	};
+
+	socket.onmessage = async event => {
+		const message = JSON.parse(event.data);
+		if (message.type === 'partial') {
+			statusDiv.textContent = message.text;
+		} else if (message.type === 'transcript') {
+			stopRecording();
+			streamingBubble = null;
+			streamingText = '';
+			appendMessage(SenderType.USER, message.text);
+			toggleSendButton(true);
+			renderer = createResponseRenderer(usedChannel);
+		} else if (renderer) {
+			if (message.type === 'done') answered = true;
+			await renderer.onEvent(message);
+		} else if (message.type === 'error') {
+			failed = true;
+			stopRecording();
+			statusDiv.textContent = '';
+			appendMessage(SenderType.AI, message.detail, false, true);
+		}
+	};
+
+	socket.onerror = () => {
+		console.error('Voice connection error');
+	};
+
+	// The connection can drop before the answer is complete, e.g. when the
+	// server restarts; the recording state is reset and the user told so.
+	socket.onclose = async () => {
+		if (answered || failed) return;
+		stopRecording();
+		statusDiv.textContent = '';
+		if (renderer) {
+			await renderer.onEvent({
+				type: 'error',
+				detail: '\n\nThe connection was lost before the answer was complete.',
+			});
+			await renderer.finish();
+			if (!currentAudio || currentAudio.paused) toggleSendButton(false);
+		} else {
+			appendMessage(
+				SenderType.AI,
+				'The voice connection was lost. Please try again.',
+				false,
+				true
+			);
+		}
+	};
+
+	const sendAudio = chunk => {
+		if (socket.readyState === WebSocket.OPEN) {
+			socket.send(chunk);
+		} else if (socket.readyState === WebSocket.CONNECTING) {
+			pending.push(chunk);
+		}
+	};
+
+	const stop = () => {
+		if (renderer) return;
+		if (socket.readyState === WebSocket.OPEN) {
+			socket.send(JSON.stringify({ type: 'stop' }));
+		}
+		statusDiv.textContent = 'Processing audio...';
+	};
+
+	return { sendAudio, stop };
+}
+
 function stopRecording() {
-	if (!mediaRecorder || !stream) return;
+	if (!mediaRecorder || !stream || mediaRecorder.state === 'inactive')
+		return;
 	mediaRecorder.stop();
 	stream.getTracks().forEach(track => track.stop());
 	silenceCheckId && cancelAnimationFrame(silenceCheckId);
@@ -1021,6 +1264,9 @@ function setupSilenceDetection(stream) {
 }
 
 function stopAudio() {
+	audioSegments = [];
+	isSegmentPlaying = false;
+	isSegmentPlaybackStopped = true;
 	if (currentAudio) {
 		currentAudio.pause();
 		currentAudio.currentTime = 0;
@@ -0,0 +1,322 @@
+"""
+Speech recognition backends and the worker pool they run in. Jobs go to a
+thread or process pool with a bounded number of waiting jobs and a per-job
+timeout, and the pool keeps queue depth and latency figures for
+/api/stt/metrics.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+from config import (
+    stt_backend,
+    stt_executor,
+    stt_fake_latency,
+    stt_fake_text,
+    stt_max_queue,
+    stt_timeout,
+    stt_vosk_model,
+    stt_workers,
+)
+from logs import setup_worker_logging
+from metrics import percentile
+
+# Number of recent jobs the latency percentiles are computed over.
+LATENCY_WINDOW = 1000
+
+# Raw PCM handed to the recognizers: 16 kHz, mono, 16 bit little endian.
+PCM_SAMPLE_RATE = 16000
+PCM_SAMPLE_WIDTH = 2
+
+
+class GoogleSTT:
+    """The free Google Web Speech API used by speech_recognition."""
+
+    def __init__(self):
+        import speech_recognition as sr
+
+        self._sr = sr
+
+    def recognize(self, pcm: bytes, language: str) -> str:
+        audio = self._sr.AudioData(pcm, PCM_SAMPLE_RATE, PCM_SAMPLE_WIDTH)
+        return self._sr.Recognizer().recognize_google(audio, language=language)
+
+
+class VoskSTT:
+    """
+    Offline recognition with a Vosk model. The model is loaded once per
+    process and shared by all requests; it is trained for one language, so
+    `language` is ignored.
+    """
+
+    def __init__(self, model_path: str):
+        try:
+            import vosk
+        except ImportError as e:
+            raise RuntimeError(
+                "STT_BACKEND=vosk needs the vosk package: pip install vosk"
+            ) from e
+        if not model_path:
+            raise RuntimeError("STT_BACKEND=vosk needs STT_VOSK_MODEL to be set")
+
+        vosk.SetLogLevel(-1)
+        self._vosk = vosk
+        started = time.perf_counter()
+        self._model = vosk.Model(model_path)
+        logging.info(
+            "Loaded Vosk model %s in %.1fs", model_path, time.perf_counter() - started
+        )
+
+    def recognize(self, pcm: bytes, language: str) -> str:
+        recognizer = self._vosk.KaldiRecognizer(self._model, PCM_SAMPLE_RATE)
+        recognizer.AcceptWaveform(pcm)
+        return json.loads(recognizer.FinalResult()).get("text", "")
+
+    def stream(self, language: str):
+        return _VoskStream(self._vosk.KaldiRecognizer(self._model, PCM_SAMPLE_RATE))
+
+
+class _VoskStream:
+    """Recognition of one utterance that is fed while it is being spoken."""
+
+    def __init__(self, recognizer):
+        self._recognizer = recognizer
+        self._phrases = []
+
+    def _text(self) -> str:
+        return " ".join(phrase for phrase in self._phrases if phrase)
+
+    def accept(self, pcm: bytes) -> str:
+        """Feed audio and return the transcript so far."""
+        if self._recognizer.AcceptWaveform(pcm):
+            self._phrases.append(json.loads(self._recognizer.Result())["text"])
+            return self._text()
+        partial = json.loads(self._recognizer.PartialResult())["partial"]
+        return " ".join(text for text in (self._text(), partial) if text)
+
+    def finish(self) -> str:
+        self._phrases.append(json.loads(self._recognizer.FinalResult())["text"])
+        return self._text()
+
+
+class FakeSTT:
+    """Returns a fixed transcript after a delay, for tests and benchmarks."""
+
+    def __init__(self, text: str, latency: float):
+        self.text = text
+        self.latency = latency
+
+    def recognize(self, pcm: bytes, language: str) -> str:
+        time.sleep(self.latency)
+        return self.text
+
+
+STT_BACKENDS = {
+    "google": GoogleSTT,
+    "vosk": lambda: VoskSTT(stt_vosk_model),
+    "fake": lambda: FakeSTT(stt_fake_text, stt_fake_latency),
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_stt_backend(name: str = stt_backend):
+    """Return the backend called `name`, creating it once per process."""
+    backend = _backends.get(name)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(name)
+            if backend is None:
+                if name not in STT_BACKENDS:
+                    raise ValueError(f"Unknown STT backend: {name}")
+                backend = _backends[name] = STT_BACKENDS[name]()
+    return backend
+
+
+def recognize(pcm: bytes, language: str, backend: str = stt_backend) -> str:
+    """Transcribe PCM audio; runs inside the pool's workers."""
+    return get_stt_backend(backend).recognize(pcm, language)
+
+
+def _timed_call(func, *args):
+    """Run `func` in a worker and report when it actually started."""
+    return time.time(), func(*args)
+
+
+def _log_warm_up_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("Could not load the STT backend: %s", future.exception())
+
+
+class STTPool:
+    """A bounded worker pool for blocking speech recognition calls."""
+
+    def __init__(self, workers: int, max_queue: int, timeout: float, kind: str):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown STT executor: {kind}")
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.kind = kind
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self._wait_times = deque(maxlen=LATENCY_WINDOW)
+        self._run_times = deque(maxlen=LATENCY_WINDOW)
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(
+                    self.workers, initializer=setup_worker_logging
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="stt"
+                )
+        return self._executor
+
+    @property
+    def running(self) -> int:
+        return min(self.in_flight, self.workers)
+
+    @property
+    def queued(self) -> int:
+        return max(self.in_flight - self.workers, 0)
+
+    def _job_done(self, future):
+        # Runs when the worker finishes, even after the caller timed out, so
+        # a hung job keeps its slot until it really ends.
+        self.in_flight -= 1
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.failed += 1
+            return
+        started_at, _ = future.result()
+        self._run_times.append(time.time() - started_at)
+        self.completed += 1
+
+    async def run(self, func, *args):
+        """
+        Run `func(*args)` in the pool. Raises a 503 HTTPException when too
+        many jobs are waiting and a 504 when the job takes longer than the
+        configured timeout.
+        """
+        if self.in_flight >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Speech recognition is busy, please try again.",
+                headers={"Retry-After": "5"},
+            )
+
+        submitted_at = time.time()
+        future = self._get_executor().submit(_timed_call, func, *args)
+        self.in_flight += 1
+        loop = asyncio.get_running_loop()
+
+        def on_done(done):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(self._job_done, done)
+
+        future.add_done_callback(on_done)
+        try:
+            started_at, result = await asyncio.wait_for(
+                asyncio.wrap_future(future), self.timeout
+            )
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            logging.error("Speech recognition timed out after %.1fs", self.timeout)
+            raise HTTPException(
+                status_code=504, detail="Speech recognition timed out."
+            ) from None
+        finally:
+            # Drops the job if it has not started yet; a running one finishes.
+            future.cancel()
+        self._wait_times.append(started_at - submitted_at)
+        return result
+
+    def metrics(self) -> dict:
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "queued": self.queued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "rejected": self.rejected,
+            "queue_wait_p50": percentile(self._wait_times, 50),
+            "queue_wait_p95": percentile(self._wait_times, 95),
+            "run_time_p50": percentile(self._run_times, 50),
+            "run_time_p95": percentile(self._run_times, 95),
+        }
+
+    def warm_up(self):
+        """Load the configured backend in the workers ahead of the first job."""
+        executor = self._get_executor()
+        for _ in range(self.workers if self.kind == "process" else 1):
+            executor.submit(get_stt_backend).add_done_callback(_log_warm_up_error)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+stt_pool = STTPool(stt_workers, stt_max_queue, stt_timeout, stt_executor)
+
+
+class BufferedRecognition:
+    """Collects an utterance and recognizes it in one go when it is over."""
+
+    def __init__(self, language: str):
+        self.language = language
+        self._chunks = []
+
+    async def accept(self, pcm: bytes) -> str | None:
+        self._chunks.append(pcm)
+        return None
+
+    async def finish(self) -> str:
+        return await stt_pool.run(recognize, b"".join(self._chunks), self.language)
+
+
+class IncrementalRecognition:
+    """Feeds an utterance to a streaming backend while it is being spoken."""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    async def accept(self, pcm: bytes) -> str | None:
+        return await stt_pool.run(self._stream.accept, pcm)
+
+    async def finish(self) -> str:
+        return await stt_pool.run(self._stream.finish)
+
+
+async def open_recognition(language: str):
+    """
+    Start recognizing a live utterance. Backends that can decode while audio
+    arrives (Vosk) do so in the thread pool; the others, and every backend in
+    a process pool where the recognizer state cannot be shared, get the whole
+    utterance at the end.
+    """
+    if stt_pool.kind == "thread":
+        backend = await stt_pool.run(get_stt_backend)
+        if hasattr(backend, "stream"):
+            return IncrementalRecognition(backend.stream(language))
+    return BufferedRecognition(language)
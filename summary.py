@@ -0,0 +1,149 @@
+"""
+Rolling summaries of long channels. After a turn is saved, channels whose
+unsummarized messages exceed a token threshold get their older messages
+folded into a stored summary by a small Ollama model. The work runs in the
+background and only the messages added since the previous summary are sent,
+together with that summary.
+"""
+
+import asyncio
+import logging
+
+from fastapi import HTTPException
+
+from chat import chat_storage_manager, run_db
+from config import (
+    summary_keep_tokens,
+    summary_max_words,
+    summary_model,
+    summary_trigger_tokens,
+)
+from context import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+from ollama import ask_ollama, does_model_exist
+from scheduler import chat_scheduler
+
+SUMMARY_PROMPT = (
+    "You keep a running summary of a conversation between a user and an AI "
+    "assistant. Update the summary with the new messages. Keep names, facts, "
+    "decisions, open questions and the user's preferences; drop small talk. "
+    "Reply with the updated summary only, in at most {words} words."
+)
+
+
+def _split_for_summary(rows, keep_tokens: int, batch_tokens: int):
+    """
+    Given the unsummarized rows oldest first, return the oldest of them, at
+    most `batch_tokens` worth, leaving out the newest `keep_tokens` worth.
+    The batch starts at the first unsummarized row, so the summary covers
+    every row up to the last one in the batch.
+    """
+    sizes = [
+        (token_count or estimate_tokens(content)) + MESSAGE_OVERHEAD_TOKENS
+        for _, _, content, token_count in rows
+    ]
+    # Rows from keep_start on are kept out of the summary.
+    keep_start = len(rows)
+    kept = 0
+    while keep_start > 0 and kept + sizes[keep_start - 1] <= keep_tokens:
+        keep_start -= 1
+        kept += sizes[keep_start]
+
+    batch = []
+    taken = 0
+    for (sequence, role, content, _), tokens in zip(rows[:keep_start], sizes):
+        if taken + tokens > batch_tokens and batch:
+            break
+        batch.append((sequence, role, content))
+        taken += tokens
+    return batch
+
+
+class ChannelSummarizer:
+    """Schedules at most one summary update per channel at a time."""
+
+    def __init__(
+        self, model: str, trigger_tokens: int, keep_tokens: int, max_words: int
+    ):
+        self.model = model
+        self.trigger_tokens = trigger_tokens
+        self.keep_tokens = keep_tokens
+        self.max_words = max_words
+        self._tasks: dict[tuple[str, str], asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.model)
+
+    def schedule(self, user_id: str, channel_id: str):
+        """Check the channel in the background after a turn was saved."""
+        key = (user_id, channel_id)
+        if not self.enabled or key in self._tasks:
+            return
+        task = asyncio.create_task(self._update(user_id, channel_id))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+    async def _update(self, user_id: str, channel_id: str):
+        try:
+            summary, _, rows = await run_db(
+                chat_storage_manager.load_unsummarized_messages, user_id, channel_id
+            )
+            pending_tokens = sum(
+                (token_count or estimate_tokens(content)) + MESSAGE_OVERHEAD_TOKENS
+                for _, _, content, token_count in rows
+            )
+            if pending_tokens < self.trigger_tokens:
+                return
+
+            batch = _split_for_summary(rows, self.keep_tokens, self.trigger_tokens)
+            if not batch or not await does_model_exist(self.model):
+                return
+
+            transcript = "\n".join(f"{role}: {content}" for _, role, content in batch)
+            messages = [
+                {
+                    "role": "system",
+                    "content": SUMMARY_PROMPT.format(words=self.max_words),
+                },
+                {
+                    "role": "user",
+                    "content": f"Current summary:\n{summary or '(none)'}\n\n"
+                    f"New messages:\n{transcript}",
+                },
+            ]
+            async with chat_scheduler.background(self.model):
+                new_summary = await ask_ollama(self.model, messages)
+            if not new_summary:
+                return
+
+            new_summary = new_summary.strip()
+            await run_db(
+                chat_storage_manager.save_channel_summary,
+                user_id,
+                channel_id,
+                new_summary,
+                batch[-1][0],
+                estimate_tokens(new_summary),
+            )
+            logging.info(
+                "Summarized %d messages of channel %s up to sequence %d",
+                len(batch),
+                channel_id,
+                batch[-1][0],
+            )
+        except HTTPException as e:
+            # The summary model is busy; the next turn tries again.
+            logging.info("Skipped summary of channel %s: %s", channel_id, e.detail)
+        except Exception as e:
+            logging.error("Summary of channel %s failed: %s", channel_id, e)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+channel_summarizer = ChannelSummarizer(
+    summary_model, summary_trigger_tokens, summary_keep_tokens, summary_max_words
+)
@@ -0,0 +1,68 @@
+"""
+Names new channels in the background. A channel is created with a
+provisional title taken from its first message; the real title is generated
+while the first answer streams and then stored and sent to the client.
+"""
+
+import asyncio
+import logging
+
+from fastapi import HTTPException
+
+from chat import chat_storage_manager, generate_summary_title, run_db
+from config import title_model
+from ollama import ask_ollama, does_model_exist
+from scheduler import chat_scheduler
+
+TITLE_PROMPT = (
+    "Write a title of at most six words for a chat that starts with the "
+    "following message. Reply with the title only, without quotes."
+)
+# Longest title stored, in characters.
+MAX_TITLE_LENGTH = 80
+
+
+async def _llm_title(text: str) -> str | None:
+    if not await does_model_exist(title_model):
+        logging.warning("Title model %s does not exist", title_model)
+        return None
+    messages = [
+        {"role": "system", "content": TITLE_PROMPT},
+        {"role": "user", "content": text},
+    ]
+    async with chat_scheduler.background(title_model):
+        return await ask_ollama(title_model, messages)
+
+
+async def _summary_title(text: str) -> str | None:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, generate_summary_title, text)
+
+
+def _clean_title(title: str | None) -> str | None:
+    title = " ".join((title or "").split()).strip("\"'")
+    return title[:MAX_TITLE_LENGTH].rstrip() or None
+
+
+async def name_channel(user_id: str, channel_id: str, text: str) -> str | None:
+    """Generate and store the title of a new channel; returns it or None."""
+    try:
+        if title_model:
+            title = await _llm_title(text)
+        else:
+            title = await _summary_title(text)
+        title = _clean_title(title)
+        if title:
+            await run_db(
+                chat_storage_manager.rename_channel, user_id, channel_id, title
+            )
+        return title
+    except HTTPException as e:
+        logging.info("Kept provisional title of %s: %s", channel_id, e.detail)
+    except Exception as e:
+        logging.error("Could not generate a title for %s: %s", channel_id, e)
+    return None
+
+
+def start_naming_channel(user_id: str, channel_id: str, text: str) -> asyncio.Task:
+    return asyncio.create_task(name_channel(user_id, channel_id, text))
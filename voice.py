@@ -0,0 +1,101 @@
+"""
+Live voice input. The browser sends recording chunks over a WebSocket while
+the user is speaking; they are decoded by one ffmpeg process, fed to the
+recognizer and watched for the end of speech, so the transcript is ready
+right after the user stops talking instead of after upload and transcoding.
+"""
+
+import asyncio
+import json
+import logging
+
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+
+from config import (
+    voice_end_silence_ms,
+    voice_listen_timeout,
+    voice_max_seconds,
+    voice_vad_threshold,
+)
+from speech import EndOfSpeechDetector, StreamingTranscoder
+from stt import open_recognition
+
+# Bytes of PCM handed to the detector and recognizer at once (100 ms).
+PCM_READ_SIZE = 3200
+
+
+async def _receive_audio(websocket: WebSocket, transcoder: StreamingTranscoder):
+    """Pass audio chunks to ffmpeg until the client says it stopped recording."""
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes"):
+                await transcoder.write(message["bytes"])
+            elif message.get("text"):
+                if json.loads(message["text"]).get("type") == "stop":
+                    return
+    finally:
+        transcoder.close_input()
+
+
+async def listen(websocket: WebSocket, language: str = "tr") -> str:
+    """
+    Recognize one utterance streamed over `websocket`. Partial transcripts are
+    sent as {"type": "partial"} messages when the backend produces them.
+    Returns when speech ended, the client stopped recording, or the maximum
+    length was reached. Failures of ffmpeg or the recognizer raise a 400
+    HTTPException, as for an uploaded recording, and a client that does not
+    deliver its utterance within VOICE_LISTEN_TIMEOUT a 408.
+    """
+    try:
+        return await asyncio.wait_for(
+            _listen(websocket, language), voice_listen_timeout
+        )
+    except (HTTPException, WebSocketDisconnect):
+        raise
+    except asyncio.TimeoutError:
+        logging.info("Live voice input timed out")
+        raise HTTPException(status_code=408, detail="No utterance received in time.")
+    except Exception as e:
+        error = str(e) or "No speech detected in the audio."
+        logging.error("Live speech recognition error: %s", error)
+        raise HTTPException(
+            status_code=400, detail=f"Audio processing failed: {error}"
+        ) from e
+
+
+async def _listen(websocket: WebSocket, language: str) -> str:
+    transcoder = StreamingTranscoder()
+    await transcoder.start()
+    detector = EndOfSpeechDetector(
+        voice_vad_threshold, voice_end_silence_ms, int(voice_max_seconds * 1000)
+    )
+    recognition = await open_recognition(language)
+    receiver = asyncio.create_task(_receive_audio(websocket, transcoder))
+
+    try:
+        last_partial = ""
+        while True:
+            pcm = await transcoder.read(PCM_READ_SIZE)
+            if not pcm:
+                break
+            partial = await recognition.accept(pcm)
+            if partial and partial != last_partial:
+                last_partial = partial
+                await websocket.send_json({"type": "partial", "text": partial})
+            if detector.feed(pcm):
+                logging.info("End of speech detected")
+                break
+    finally:
+        receiver_done = receiver.done()
+        receiver.cancel()
+        await transcoder.aclose()
+        if receiver_done and not receiver.cancelled():
+            # Surfaces a client disconnect that ended the audio early.
+            receiver.result()
+
+    if not detector.heard_speech:
+        return ""
+    return await recognition.finish()
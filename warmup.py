@@ -0,0 +1,56 @@
+"""
+Loads the heavy NLP and speech dependencies ahead of the first request that
+needs them. Nothing here runs at import time; depending on STARTUP_WARMUP the
+server loads them before accepting requests, in the background, or not at all
+so each one is loaded on first use.
+"""
+
+import asyncio
+import logging
+import time
+
+from ai import detect_language
+from chat import generate_summary_title
+from config import startup_warmup, tts_backend
+from stt import stt_pool
+
+WARMUP_MODES = ("lazy", "background", "eager")
+
+
+def _load_tts():
+    if tts_backend == "edge":
+        import edge_tts  # noqa: F401
+
+
+# The language detector loads its model on the first classification.
+WARMUP_STEPS = {
+    "langid": lambda: detect_language("warm up"),
+    "titles": lambda: generate_summary_title("Warm up."),
+    "tts": _load_tts,
+}
+
+
+def warm_up():
+    """Run every warm-up step, logging failures instead of raising them."""
+    for name, step in WARMUP_STEPS.items():
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logging.error("Warm-up of %s failed: %s", name, e)
+            continue
+        logging.info(
+            "Warmed up %s in %.2f seconds", name, time.perf_counter() - started
+        )
+
+
+async def start_warm_up(mode: str = startup_warmup):
+    """Warm up according to `mode`; only eager mode waits for it."""
+    if mode not in WARMUP_MODES:
+        raise ValueError(f"STARTUP_WARMUP must be one of {', '.join(WARMUP_MODES)}")
+    if mode == "lazy":
+        return
+    stt_pool.warm_up()
+    pending = asyncio.get_running_loop().run_in_executor(None, warm_up)
+    if mode == "eager":
+        await pending